@@ -1,2 +1,10 @@
-from .nvme import Root, Subsystem, Namespace, Port, Host, Referral, ANAGroup,\
-    DEFAULT_SAVE_FILE
+from .nvme import Root, Subsystem, Namespace, Passthru, Port, Host, \
+    Referral, ANAGroup, AccessIndex, Capabilities, CFSError, CFSNotFound, \
+    load_config, validate_config, DEFAULT_SAVE_FILE, DEFAULT_SAVE_DIR, \
+    DEFAULT_LOCK_DIR
+from .plan import RestorePlan, OpStats, DEFAULT_STATS_FILE
+from .journal import RestoreJournal, DEFAULT_JOURNAL_FILE
+from .history import History, DEFAULT_HISTORY_DIR
+from .lock import LockManager
+from .report import Report
+from .model import Config
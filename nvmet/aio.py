@@ -0,0 +1,342 @@
+'''
+asyncio interface to the NVMe target configfs hierarchy
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+License for the specific language governing permissions and limitations
+under the License.
+
+Every configfs access of the blocking nvmet objects is run on a bounded
+thread pool, so that slow operations like enabling a Namespace on a slow
+backing device don't stall the event loop.  Independent subtrees, e.g.
+different Subsystems during a restore, are processed concurrently.  This
+module needs python 3.7 or later.
+'''
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from . import nvme
+
+DEFAULT_WORKERS = 8
+
+
+class AsyncCFSNode(object):
+    '''
+    Wraps a blocking CFSNode, running its configfs accesses on the
+    executor of the AsyncRoot it was obtained from.
+    '''
+
+    def __init__(self, node, executor):
+        self.node = node
+        self._executor = executor
+
+    def __eq__(self, other):
+        return self.node == other.node
+
+    def __ne__(self, other):
+        return self.node != other.node
+
+    def __repr__(self):
+        return "<Async %s>" % repr(self.node)[1:-1]
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    def _wrap(self, cls, node):
+        return cls(node, self._executor)
+
+    path = property(lambda self: self.node.path,
+                    doc="Get the configFS object path.")
+    attr_groups = property(lambda self: self.node.attr_groups,
+                           doc="Get the attribute groups.")
+
+    async def exists(self):
+        return await self._run(lambda: self.node.exists)
+
+    async def list_attrs(self, group, writable=None):
+        return await self._run(self.node.list_attrs, group, writable)
+
+    async def get_attr(self, group, attribute):
+        return await self._run(self.node.get_attr, group, attribute)
+
+    async def set_attr(self, group, attribute, value):
+        await self._run(self.node.set_attr, group, attribute, value)
+
+    async def get_enable(self):
+        return await self._run(self.node.get_enable)
+
+    async def set_enable(self, value):
+        await self._run(self.node.set_enable, value)
+
+    async def delete(self):
+        await self._run(self.node.delete)
+
+    async def dump(self):
+        return await self._run(self.node.dump)
+
+
+class AsyncRoot(AsyncCFSNode):
+    '''
+    asyncio counterpart of Root.  Create it with open(), and close() it to
+    shut down its executor.
+    '''
+
+    @classmethod
+    async def open(cls, max_workers=DEFAULT_WORKERS):
+        '''
+        @param max_workers: The maximum number of configfs operations run
+            at the same time.
+        @return: An AsyncRoot object.
+        '''
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        loop = asyncio.get_running_loop()
+        try:
+            root = await loop.run_in_executor(executor, nvme.Root)
+        except Exception:
+            executor.shutdown(wait=False)
+            raise
+        return cls(root, executor)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def subsystems(self):
+        nodes = await self._run(lambda: list(self.node.subsystems))
+        return [self._wrap(AsyncSubsystem, s) for s in nodes]
+
+    async def ports(self):
+        nodes = await self._run(lambda: list(self.node.ports))
+        return [self._wrap(AsyncPort, p) for p in nodes]
+
+    async def hosts(self):
+        nodes = await self._run(lambda: list(self.node.hosts))
+        return [self._wrap(AsyncHost, h) for h in nodes]
+
+    async def subsystem(self, nqn=None, mode='any'):
+        return self._wrap(AsyncSubsystem,
+                          await self._run(nvme.Subsystem, nqn, mode))
+
+    async def port(self, portid, mode='any'):
+        return self._wrap(AsyncPort, await self._run(nvme.Port, portid, mode))
+
+    async def host(self, nqn, mode='any'):
+        return self._wrap(AsyncHost, await self._run(nvme.Host, nqn, mode))
+
+    async def sync_allowed_hosts(self, acl, by_host=False, create_hosts=True):
+        return await self._run(self.node.sync_allowed_hosts, acl, by_host,
+                               create_hosts)
+
+    async def export_subsystems(self, nqns, trtype=None, adrfam=None,
+                                portids=None, trtype_order=None):
+        return await self._run(self.node.export_subsystems, nqns, trtype,
+                               adrfam, portids, trtype_order)
+
+    async def access_index(self):
+        return await self._run(self.node.access_index)
+
+    async def save_to_file(self, savefile=None):
+        await self._run(self.node.save_to_file, savefile)
+
+    async def dump(self):
+        '''
+        Like Root.dump(), with all Subsystems, Ports and Hosts read
+        concurrently.
+        '''
+        subsystems, ports, hosts = await asyncio.gather(
+            self.subsystems(), self.ports(), self.hosts())
+        objs = await asyncio.gather(*[o.dump() for o in
+                                      subsystems + ports + hosts])
+        d = await self._run(nvme.CFSNode.dump, self.node)
+        d['subsystems'] = objs[:len(subsystems)]
+        d['ports'] = objs[len(subsystems):len(subsystems) + len(ports)]
+        d['hosts'] = objs[len(subsystems) + len(ports):]
+        return d
+
+    async def clear_existing(self):
+        '''
+        Remove entire current configuration, deleting the Ports, then the
+        Subsystems and then the Hosts concurrently.
+        '''
+        for objs in (self.ports, self.subsystems, self.hosts):
+            await asyncio.gather(*[o.delete() for o in await objs()])
+
+    async def restore(self, config, clear_existing=False,
+                      abort_on_error=False):
+        '''
+        Like Root.restore(), after validating the config the Hosts and
+        then the Ports are set up concurrently, and then the Subsystems,
+        each linked to its Ports as soon as it is set up.  Returns the
+        list of non-fatal errors, or raises the first error if
+        abort_on_error is set.
+        '''
+        errors = nvme.validate_config(config)
+        if errors:
+            raise nvme.CFSError("Invalid configuration, not restoring:\n%s" %
+                                "\n".join(errors))
+
+        # The lock is taken and released on one dedicated thread, as the
+        # executor may run its __enter__ and __exit__ on different ones
+        lock = self.node.lock()
+        lock_thread = ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(lock_thread, lock.__enter__)
+            try:
+                return await self._restore(config, clear_existing,
+                                           abort_on_error)
+            finally:
+                await loop.run_in_executor(lock_thread, lock.__exit__,
+                                           None, None, None)
+        finally:
+            lock_thread.shutdown(wait=False)
+
+    async def _restore(self, config, clear_existing, abort_on_error):
+        if clear_existing:
+            await self.clear_existing()
+        elif await self.subsystems():
+            raise nvme.CFSError("subsystems present, not restoring")
+
+        errors = []
+
+        if abort_on_error:
+            def err_func(err_str):
+                raise nvme.CFSError(err_str)
+        else:
+            def err_func(err_str):
+                errors.append(err_str + ", skipped")
+
+        links = {}
+        for t in config.get('ports', []):
+            for nqn in t.get('subsystems', []):
+                links.setdefault(nqn, []).append(t.get('portid'))
+        ports = {}
+
+        def setup_subsystem(t, err_func):
+            nvme.Subsystem.setup(t, err_func)
+            self.node._link_subsystem(t['nqn'], links.get(t['nqn'], []),
+                                      ports, err_func)
+
+        for kind, key, setup in (
+                ('hosts', 'nqn', nvme.Host.setup),
+                ('ports', 'portid',
+                 functools.partial(nvme.Port.setup, self.node, link=False)),
+                ('subsystems', 'nqn', setup_subsystem)):
+            jobs = []
+            for index, t in enumerate(config.get(kind, [])):
+                if key not in t:
+                    err_func("'%s' not defined in %s %d" %
+                             (key, kind[:-1], index))
+                    continue
+                jobs.append(self._run(setup, t, err_func))
+            await asyncio.gather(*jobs)
+
+        return errors
+
+    async def restore_from_file(self, savefile=None, clear_existing=True,
+                                abort_on_error=False):
+        config = await self._run(nvme.load_config, savefile)
+        return await self.restore(config, clear_existing, abort_on_error)
+
+
+class AsyncSubsystem(AsyncCFSNode):
+    '''
+    asyncio counterpart of Subsystem.
+    '''
+
+    nqn = property(lambda self: self.node.nqn, doc="Get the NQN.")
+
+    async def namespaces(self):
+        nodes = await self._run(lambda: list(self.node.namespaces))
+        return [self._wrap(AsyncNamespace, n) for n in nodes]
+
+    async def namespace(self, nsid=None, mode='any'):
+        '''
+        Look up or create a Namespace.  Creating Namespaces without I{nsid}
+        concurrently in the same Subsystem may pick the same NSID.
+        '''
+        return self._wrap(AsyncNamespace,
+                          await self._run(nvme.Namespace, self.node, nsid,
+                                          mode))
+
+    async def allowed_hosts(self):
+        return await self._run(lambda: self.node.allowed_hosts)
+
+    async def add_allowed_host(self, nqn):
+        await self._run(self.node.add_allowed_host, nqn)
+
+    async def remove_allowed_host(self, nqn):
+        await self._run(self.node.remove_allowed_host, nqn)
+
+    async def set_allowed_hosts(self, nqns):
+        return await self._run(self.node.set_allowed_hosts, nqns)
+
+    async def set_enable_all(self, value):
+        '''
+        Enable or disable all Namespaces of the Subsystem concurrently.
+        '''
+        await asyncio.gather(*[ns.set_enable(value)
+                               for ns in await self.namespaces()])
+
+
+class AsyncNamespace(AsyncCFSNode):
+    '''
+    asyncio counterpart of Namespace.
+    '''
+
+    nsid = property(lambda self: self.node.nsid, doc="Get the NSID.")
+
+    async def grpid(self):
+        return await self._run(lambda: self.node.grpid)
+
+    async def set_grpid(self, grpid):
+        await self._run(self.node.set_grpid, grpid)
+
+    async def reconfigure(self, changes):
+        return await self._run(self.node.reconfigure, changes)
+
+    async def revalidate_size(self):
+        return await self._run(self.node.revalidate_size)
+
+
+class AsyncPort(AsyncCFSNode):
+    '''
+    asyncio counterpart of Port.
+    '''
+
+    portid = property(lambda self: self.node.portid, doc="Get the Port ID.")
+
+    async def subsystems(self):
+        return await self._run(lambda: self.node.subsystems)
+
+    async def add_subsystem(self, nqn):
+        await self._run(self.node.add_subsystem, nqn)
+
+    async def remove_subsystem(self, nqn):
+        await self._run(self.node.remove_subsystem, nqn)
+
+    async def referrals(self):
+        nodes = await self._run(lambda: list(self.node.referrals))
+        return [self._wrap(AsyncCFSNode, r) for r in nodes]
+
+    async def ana_groups(self):
+        nodes = await self._run(lambda: list(self.node.ana_groups))
+        return [self._wrap(AsyncCFSNode, a) for a in nodes]
+
+
+class AsyncHost(AsyncCFSNode):
+    '''
+    asyncio counterpart of Host.
+    '''
+
+    nqn = property(lambda self: self.node.nqn, doc="Get the NQN.")
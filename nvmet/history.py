@@ -0,0 +1,135 @@
+'''
+Content-addressed history of saved NVMe target configurations
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+License for the specific language governing permissions and limitations
+under the License.
+
+Every Host, Subsystem and Port of a snapshot is stored once as a blob
+named by the digest of its content, so unchanged objects are shared by
+all the snapshots they appear in:
+
+    objects/ab/cdef...   one object in json format
+    snapshots/<id>       the object digests of one snapshot
+    log                  "<time> <id>" per snapshot, oldest first
+'''
+
+import hashlib
+import json
+import os
+import time
+
+from .nvme import CFSError, _write_file, _sync_dir
+
+DEFAULT_HISTORY_DIR = '/etc/nvmet/history'
+
+_KINDS = ['hosts', 'subsystems', 'ports']
+
+
+def _to_json(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+def _digest(data):
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class History(object):
+    '''
+    A store of configuration snapshots, see the module documentation.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_HISTORY_DIR
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def _put(self, path, data):
+        if os.path.exists(path):
+            return False
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        _write_file(path, data)
+        return True
+
+    def snapshot(self, config):
+        '''
+        Add a snapshot of the config dict, unless it is the same as the
+        latest one.  Only objects that aren't stored yet are written.
+        @return: The snapshot id.
+        '''
+        manifest = {}
+        for kind in _KINDS:
+            manifest[kind] = []
+            for obj in config.get(kind, []):
+                data = _to_json(obj)
+                digest = _digest(data)
+                self._put(self._object_path(digest), data)
+                manifest[kind].append(digest)
+
+        data = _to_json(manifest)
+        snapshot_id = _digest(data)
+        self._put(os.path.join(self.path, 'snapshots', snapshot_id), data)
+
+        snapshots = self.snapshots()
+        if not snapshots or snapshots[-1][1] != snapshot_id:
+            with open(os.path.join(self.path, 'log'), "a") as f:
+                f.write("%d %s\n" % (time.time(), snapshot_id))
+                f.flush()
+                os.fsync(f.fileno())
+            _sync_dir(self.path)
+        return snapshot_id
+
+    def snapshots(self):
+        '''
+        @return: The list of (time, id) of the snapshots, oldest first.
+        '''
+        try:
+            with open(os.path.join(self.path, 'log'), "r") as f:
+                lines = f.read().split("\n")
+        except IOError:
+            return []
+        snapshots = []
+        for line in lines:
+            if line:
+                t, snapshot_id = line.split(" ", 1)
+                snapshots.append((int(t), snapshot_id))
+        return snapshots
+
+    def resolve(self, name):
+        '''
+        @param name: A snapshot id or a unique prefix of one.
+        @return: The full snapshot id.
+        '''
+        ids = set(snapshot_id for t, snapshot_id in self.snapshots()
+                  if snapshot_id.startswith(name))
+        if not name or not ids:
+            raise CFSError("No such snapshot: %s" % name)
+        if len(ids) > 1:
+            raise CFSError("Snapshot id %s is ambiguous" % name)
+        return ids.pop()
+
+    def load(self, name):
+        '''
+        @param name: A snapshot id or a unique prefix of one.
+        @return: The config dict of the snapshot.
+        '''
+        snapshot_id = self.resolve(name)
+        with open(os.path.join(self.path, 'snapshots', snapshot_id)) as f:
+            manifest = json.loads(f.read())
+        config = {}
+        for kind in _KINDS:
+            config[kind] = []
+            for digest in manifest.get(kind, []):
+                with open(self._object_path(digest), "r") as f:
+                    config[kind].append(json.loads(f.read()))
+        return config
@@ -0,0 +1,112 @@
+'''
+Progress journal that lets an interrupted restore continue where it stopped
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+License for the specific language governing permissions and limitations
+under the License.
+'''
+
+import hashlib
+import json
+import os
+
+DEFAULT_JOURNAL_FILE = '/etc/nvmet/restore.journal'
+
+_HEADER = "# nvmet restore journal "
+
+
+def config_digest(config):
+    '''
+    @return: A digest identifying the contents of a config dict.
+    '''
+    data = json.dumps(config, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class RestoreJournal(object):
+    '''
+    Records the steps completed by Root.restore(), one line per step, so
+    that a restore of the same configuration that was killed midway can
+    skip them.  Steps are identified by the path of the object they set up
+    relative to the configfs root, e.g. "subsystems/<nqn>/namespaces/1".
+    The journal is removed when a restore completes.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_JOURNAL_FILE
+        self.resumed = False
+        self.skipped = 0
+        self._done = set()
+        self._file = None
+
+    def open(self, config):
+        '''
+        Start journaling a restore of I{config}.  If the journal belongs
+        to an interrupted restore of the same config, its completed steps
+        are loaded and resumed is set, otherwise it is started afresh.  If
+        the journal can't be written, the restore goes on without one.
+        '''
+        digest = config_digest(config)
+        self.resumed = False
+        self.skipped = 0
+        self._done = set()
+        try:
+            with open(self.path, "r") as f:
+                if f.readline().rstrip("\n") == _HEADER + digest:
+                    self._done = set(line.rstrip("\n") for line in f)
+                    self._done.discard("")
+                    self.resumed = True
+        except IOError:
+            pass
+
+        try:
+            if self.resumed:
+                self._file = open(self.path, "a")
+            else:
+                self._file = open(self.path, "w")
+                self._file.write(_HEADER + digest + "\n")
+                self._file.flush()
+        except (IOError, OSError):
+            self._file = None
+
+    def done(self, step):
+        '''
+        @return: True if I{step} was completed by the interrupted restore.
+        '''
+        return step in self._done
+
+    def checkpoint(self, step):
+        '''
+        Record that I{step} has been completed.  The journal is flushed
+        but not synced: configfs does not survive a reboot either.
+        '''
+        self._done.add(step)
+        if self._file is not None:
+            self._file.write(step + "\n")
+            self._file.flush()
+
+    def close(self):
+        '''
+        Stop journaling, keeping the journal for a later resume.
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        '''
+        Stop journaling after a completed restore and remove the journal.
+        '''
+        self.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
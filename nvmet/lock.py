@@ -0,0 +1,164 @@
+'''
+Advisory locks serialising concurrent writers of the configfs hierarchy
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+License for the specific language governing permissions and limitations
+under the License.
+
+Whole-tree operations like Root.restore() take the global lock
+exclusively.  Operations on a single Subsystem, Port or Host take the
+global lock shared and the lock of that object exclusively, so operations
+on different objects run concurrently, but never during a whole-tree one.
+
+The locks are flock()s on files in the lock directory, held by an owner:
+the calling thread, unless it runs on behalf of another one, see
+acting_for().  Each owner locks its own open file, so owners wait for
+each other like separate processes do.  A lock the owner already holds is
+granted again at once, and an owner holding the global lock exclusively
+needs no object locks.
+'''
+
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+
+from .nvme import CFSError, DEFAULT_LOCK_DIR
+
+_GLOBAL = 'global'
+
+_local = threading.local()
+
+
+def current_owner():
+    '''
+    @return: The owner of the locks taken by the calling thread.
+    '''
+    owner = getattr(_local, 'owner', None)
+    if owner is None:
+        return threading.current_thread()
+    return owner
+
+
+@contextmanager
+def acting_for(owner):
+    '''
+    Take and release locks on behalf of I{owner} for the duration of a
+    with block, e.g. in the worker threads of an operation holding the
+    global lock.  I{owner} is any object, used as returned by
+    current_owner().
+    '''
+    previous = getattr(_local, 'owner', None)
+    _local.owner = owner
+    try:
+        yield
+    finally:
+        _local.owner = previous
+
+
+class LockManager(object):
+    '''
+    The locks of one lock directory, see the module documentation.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_LOCK_DIR
+        self._mutex = threading.Lock()
+        # owner -> {name: [fd, exclusive, count]}
+        self._held = {}
+
+    def _lock_file(self, name):
+        return os.path.join(self.path, "%s.lock" % name.replace('/', '_'))
+
+    def _acquire(self, name, exclusive):
+        owner = current_owner()
+        with self._mutex:
+            entry = self._held.get(owner, {}).get(name)
+            if entry is not None:
+                # Upgrading would wait for the owner itself
+                if exclusive and not entry[1]:
+                    raise CFSError("Cannot upgrade the %s lock" % name)
+                entry[2] += 1
+                return
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd = os.open(self._lock_file(name), os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            raise CFSError("Cannot open the %s lock: %s" % (name, e))
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except (IOError, OSError) as e:
+            os.close(fd)
+            raise CFSError("Cannot take the %s lock: %s" % (name, e))
+        with self._mutex:
+            held = self._held.setdefault(owner, {})
+            entry = held.get(name)
+            if entry is None:
+                held[name] = [fd, exclusive, 1]
+                return
+            # Another thread acting for the owner took it shared meanwhile
+            entry[2] += 1
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _release(self, name):
+        owner = current_owner()
+        with self._mutex:
+            held = self._held[owner]
+            entry = held[name]
+            entry[2] -= 1
+            if entry[2]:
+                return
+            del held[name]
+            if not held:
+                del self._held[owner]
+        fcntl.flock(entry[0], fcntl.LOCK_UN)
+        os.close(entry[0])
+
+    def holds_global(self):
+        '''
+        @return: True if the current owner holds the global lock
+            exclusively.
+        '''
+        with self._mutex:
+            entry = self._held.get(current_owner(), {}).get(_GLOBAL)
+            return entry is not None and entry[1]
+
+    @contextmanager
+    def locked(self, kind=None, name=None):
+        '''
+        Hold the global lock exclusively, or if kind and name are given,
+        e.g. ('subsystem', nqn), the lock of that object, for the duration
+        of a with block.
+        '''
+        if kind is None:
+            self._acquire(_GLOBAL, True)
+            try:
+                yield
+            finally:
+                self._release(_GLOBAL)
+            return
+
+        if self.holds_global():
+            yield
+            return
+        obj = "%s-%s" % (kind, name)
+        self._acquire(_GLOBAL, False)
+        try:
+            self._acquire(obj, True)
+            try:
+                yield
+            finally:
+                self._release(obj)
+        finally:
+            self._release(_GLOBAL)
@@ -0,0 +1,450 @@
+'''
+Offline model of an NVMe target configuration
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+License for the specific language governing permissions and limitations
+under the License.
+
+The classes here hold a configuration in the format of Root.dump() in
+memory, without root privileges or configfs.  They can be loaded from and
+saved to json, edited, queried and finally applied to a Root.
+'''
+
+from collections import OrderedDict
+from six import iteritems
+
+from .nvme import CFSError, Namespace, Port, ANAGroup, load_config, \
+    validate_config, _config_to_json, _write_file
+
+
+class ConfigObject(object):
+    '''
+    Base class of the offline objects.  attrs maps each attribute group
+    to a dict of attribute names and values, enable is None for objects
+    that can't be enabled.  Keys of the saved dict that aren't modelled
+    are kept in extra, so that nothing is lost when saving again.
+    '''
+
+    __slots__ = ('attrs', 'enable', 'extra')
+
+    # Keys handled by the subclass itself
+    _keys = ()
+
+    def __init__(self, attrs=None, enable=None):
+        self.attrs = attrs or {}
+        self.enable = enable
+        self.extra = {}
+
+    def _load(self, d):
+        for key, value in iteritems(d):
+            if key == 'enable':
+                self.enable = value
+            elif isinstance(value, dict):
+                self.attrs[key] = dict(value)
+            elif key not in self._keys:
+                self.extra[key] = value
+
+    def get_attr(self, group, attribute):
+        return self.attrs.get(group, {}).get(attribute)
+
+    def set_attr(self, group, attribute, value):
+        self.attrs.setdefault(group, {})[attribute] = str(value)
+
+    def to_dict(self):
+        d = dict(self.extra)
+        for group, attrs in iteritems(self.attrs):
+            d[group] = dict(attrs)
+        if self.enable is not None:
+            d['enable'] = self.enable
+        return d
+
+
+class HostConfig(ConfigObject):
+    __slots__ = ('nqn',)
+    _keys = ('nqn',)
+
+    def __init__(self, nqn):
+        super(HostConfig, self).__init__()
+        self.nqn = nqn
+
+    def __repr__(self):
+        return "<HostConfig %s>" % self.nqn
+
+    def to_dict(self):
+        d = super(HostConfig, self).to_dict()
+        d['nqn'] = self.nqn
+        return d
+
+
+class NamespaceConfig(ConfigObject):
+    __slots__ = ('nsid', 'ana_grpid', 'priority')
+    _keys = ('nsid', 'ana_grpid', 'priority')
+
+    def __init__(self, nsid, path=None, enable=0):
+        super(NamespaceConfig, self).__init__(enable=enable)
+        self.nsid = nsid
+        self.ana_grpid = None
+        self.priority = 0
+        if path is not None:
+            self.set_attr('device', 'path', path)
+
+    def __repr__(self):
+        return "<NamespaceConfig %d>" % self.nsid
+
+    def to_dict(self):
+        d = super(NamespaceConfig, self).to_dict()
+        d['nsid'] = self.nsid
+        if self.ana_grpid is not None:
+            d['ana_grpid'] = self.ana_grpid
+        if self.priority:
+            d['priority'] = self.priority
+        return d
+
+
+class SubsystemConfig(ConfigObject):
+    __slots__ = ('nqn', 'namespaces', 'allowed_hosts', 'priority')
+    _keys = ('nqn', 'namespaces', 'allowed_hosts', 'priority')
+
+    def __init__(self, nqn):
+        super(SubsystemConfig, self).__init__()
+        self.nqn = nqn
+        self.namespaces = OrderedDict()
+        self.allowed_hosts = []
+        # Higher priorities are restored first, see Root.restore()
+        self.priority = 0
+
+    def __repr__(self):
+        return "<SubsystemConfig %s>" % self.nqn
+
+    def add_namespace(self, nsid=None, path=None, enable=0):
+        '''
+        Add a Namespace, using the lowest free NSID if nsid is None.
+        '''
+        if nsid is None:
+            nsid = 1
+            while nsid in self.namespaces:
+                nsid += 1
+        nsid = int(nsid)
+        if nsid < 1 or nsid > Namespace.MAX_NSID:
+            raise CFSError("NSID must be 1 to %d" % Namespace.MAX_NSID)
+        if nsid in self.namespaces:
+            raise CFSError("NSID %d already exists in %s" % (nsid, self.nqn))
+        ns = NamespaceConfig(nsid, path, enable)
+        self.namespaces[nsid] = ns
+        return ns
+
+    def remove_namespace(self, nsid):
+        del self.namespaces[int(nsid)]
+
+    def to_dict(self):
+        d = super(SubsystemConfig, self).to_dict()
+        d['nqn'] = self.nqn
+        d['namespaces'] = [ns.to_dict() for ns in self.namespaces.values()]
+        d['allowed_hosts'] = list(self.allowed_hosts)
+        if self.priority:
+            d['priority'] = self.priority
+        return d
+
+
+class ANAGroupConfig(ConfigObject):
+    __slots__ = ('grpid',)
+    _keys = ('grpid',)
+
+    def __init__(self, grpid, state=None):
+        super(ANAGroupConfig, self).__init__()
+        self.grpid = grpid
+        if state is not None:
+            self.set_attr('ana', 'state', state)
+
+    def __repr__(self):
+        return "<ANAGroupConfig %d>" % self.grpid
+
+    def to_dict(self):
+        d = super(ANAGroupConfig, self).to_dict()
+        d['grpid'] = self.grpid
+        return d
+
+
+class ReferralConfig(ConfigObject):
+    __slots__ = ('name',)
+    _keys = ('name',)
+
+    def __init__(self, name, enable=0):
+        super(ReferralConfig, self).__init__(enable=enable)
+        self.name = name
+
+    def __repr__(self):
+        return "<ReferralConfig %s>" % self.name
+
+    def to_dict(self):
+        d = super(ReferralConfig, self).to_dict()
+        d['name'] = self.name
+        return d
+
+
+class PortConfig(ConfigObject):
+    __slots__ = ('portid', 'subsystems', 'ana_groups', 'referrals')
+    _keys = ('portid', 'subsystems', 'ana_groups', 'referrals')
+
+    def __init__(self, portid, **addr):
+        super(PortConfig, self).__init__()
+        self.portid = portid
+        self.subsystems = []
+        self.ana_groups = OrderedDict()
+        self.referrals = OrderedDict()
+        for name, value in iteritems(addr):
+            self.set_attr('addr', name, value)
+
+    def __repr__(self):
+        return "<PortConfig %d>" % self.portid
+
+    def add_ana_group(self, grpid, state=None):
+        grpid = int(grpid)
+        if grpid < 1 or grpid > ANAGroup.MAX_GRPID:
+            raise CFSError("GRPID %d must be 1 to %d" %
+                           (grpid, ANAGroup.MAX_GRPID))
+        if grpid in self.ana_groups:
+            raise CFSError("ANA Group %d already exists on port %d" %
+                           (grpid, self.portid))
+        a = ANAGroupConfig(grpid, state)
+        self.ana_groups[grpid] = a
+        return a
+
+    def add_referral(self, name, enable=0, **addr):
+        if name in self.referrals:
+            raise CFSError("Referral %s already exists on port %d" %
+                           (name, self.portid))
+        r = ReferralConfig(name, enable)
+        for attr, value in iteritems(addr):
+            r.set_attr('addr', attr, value)
+        self.referrals[name] = r
+        return r
+
+    def to_dict(self):
+        d = super(PortConfig, self).to_dict()
+        d['portid'] = self.portid
+        d['subsystems'] = list(self.subsystems)
+        d['ana_groups'] = [a.to_dict() for a in self.ana_groups.values()]
+        d['referrals'] = [r.to_dict() for r in self.referrals.values()]
+        return d
+
+
+class Config(object):
+    '''
+    An offline NVMe target configuration.  Hosts and Subsystems are kept
+    by NQN and Ports by Port ID, in the order they were added.
+    '''
+
+    __slots__ = ('hosts', 'subsystems', 'ports', 'port_profiles')
+
+    def __init__(self):
+        self.hosts = OrderedDict()
+        self.subsystems = OrderedDict()
+        self.ports = OrderedDict()
+        self.port_profiles = OrderedDict()
+
+    def __repr__(self):
+        return "<Config %d hosts, %d subsystems, %d ports>" % \
+            (len(self.hosts), len(self.subsystems), len(self.ports))
+
+    @classmethod
+    def from_dict(cls, config):
+        '''
+        Build a Config from a dict generated by Root.dump().
+        '''
+        c = cls()
+        for t in config.get('hosts', []):
+            h = c.add_host(t['nqn'])
+            h._load(t)
+        for t in config.get('subsystems', []):
+            s = c.add_subsystem(t['nqn'])
+            s._load(t)
+            s.allowed_hosts = list(t.get('allowed_hosts', []))
+            s.priority = t.get('priority', 0)
+            for n in t.get('namespaces', []):
+                ns = s.add_namespace(n['nsid'])
+                ns._load(n)
+                ns.ana_grpid = n.get('ana_grpid')
+                ns.priority = n.get('priority', 0)
+        for t in config.get('ports', []):
+            p = c.add_port(t['portid'])
+            p._load(t)
+            p.subsystems = list(t.get('subsystems', []))
+            for n in t.get('ana_groups', []):
+                p.add_ana_group(n['grpid'])._load(n)
+            for n in t.get('referrals', []):
+                p.add_referral(n['name'])._load(n)
+        for t in config.get('port_profiles', []):
+            c.port_profiles[t['name']] = dict(t)
+        return c
+
+    def to_dict(self):
+        '''
+        @return: A dict in the format of Root.dump().
+        '''
+        d = {
+            'hosts': [h.to_dict() for h in self.hosts.values()],
+            'subsystems': [s.to_dict() for s in self.subsystems.values()],
+            'ports': [p.to_dict() for p in self.ports.values()],
+        }
+        if self.port_profiles:
+            d['port_profiles'] = [dict(t) for t in self.port_profiles.values()]
+        return d
+
+    @classmethod
+    def load(cls, savefile=None):
+        '''
+        Read a Config from a json file or directory, see load_config().
+        '''
+        return cls.from_dict(load_config(savefile))
+
+    @classmethod
+    def from_root(cls, root):
+        '''
+        Read the live configuration of a Root.
+        '''
+        return cls.from_dict(root.dump())
+
+    def save(self, savefile):
+        '''
+        Write the Config to a json file, readable only by its owner like
+        the files written by Root.save_to_file().
+        '''
+        _write_file(savefile, _config_to_json(self.to_dict()))
+
+    def validate(self):
+        '''
+        Check the whole configuration, see validate_config().
+        Returns the list of problems found.
+        '''
+        return validate_config(self.to_dict())
+
+    def apply(self, root, clear_existing=False, abort_on_error=False):
+        '''
+        Restore this configuration to a Root, see Root.restore().
+        '''
+        return root.restore(self.to_dict(), clear_existing=clear_existing,
+                            abort_on_error=abort_on_error)
+
+    @staticmethod
+    def _lookup(objs, key, what):
+        try:
+            return objs[key]
+        except KeyError:
+            raise CFSError("%s %s not defined" % (what, key))
+
+    def add_host(self, nqn):
+        if nqn in self.hosts:
+            raise CFSError("Host %s already exists" % nqn)
+        h = HostConfig(nqn)
+        self.hosts[nqn] = h
+        return h
+
+    def remove_host(self, nqn):
+        '''
+        Remove a Host and all the access it was granted.
+        '''
+        self._lookup(self.hosts, nqn, "Host")
+        del self.hosts[nqn]
+        for s in self.subsystems.values():
+            if nqn in s.allowed_hosts:
+                s.allowed_hosts.remove(nqn)
+
+    def add_subsystem(self, nqn):
+        if nqn in self.subsystems:
+            raise CFSError("Subsystem %s already exists" % nqn)
+        s = SubsystemConfig(nqn)
+        self.subsystems[nqn] = s
+        return s
+
+    def remove_subsystem(self, nqn):
+        '''
+        Remove a Subsystem and its links to Ports.
+        '''
+        self._lookup(self.subsystems, nqn, "Subsystem")
+        del self.subsystems[nqn]
+        for p in self.ports.values():
+            if nqn in p.subsystems:
+                p.subsystems.remove(nqn)
+
+    def add_port(self, portid, **addr):
+        portid = int(portid)
+        if portid < 0 or portid > Port.MAX_PORTID:
+            raise CFSError("Port ID must be 0 to %d" % Port.MAX_PORTID)
+        if portid in self.ports:
+            raise CFSError("Port %d already exists" % portid)
+        p = PortConfig(portid, **addr)
+        self.ports[portid] = p
+        return p
+
+    def remove_port(self, portid):
+        portid = int(portid)
+        self._lookup(self.ports, portid, "Port")
+        del self.ports[portid]
+
+    def set_port_profile(self, name, trtype, **groups):
+        '''
+        Define or change the port profile name for Ports of transport type
+        trtype, e.g. set_port_profile('tcp-fast', 'tcp',
+        param={'inline_data_size': 16384}).  Its version is increased
+        whenever its content changes.
+        @return: The profile dict.
+        '''
+        old = self.port_profiles.get(name, {})
+        t = {'name': name, 'trtype': trtype}
+        for group, attrs in iteritems(groups):
+            t[group] = dict((k, str(v)) for k, v in iteritems(attrs))
+        version = old.get('version', 0)
+        if dict((k, v) for k, v in iteritems(old) if k != 'version') != t:
+            version += 1
+        t['version'] = version
+        self.port_profiles[name] = t
+        return t
+
+    def remove_port_profile(self, name):
+        self._lookup(self.port_profiles, name, "Port profile")
+        del self.port_profiles[name]
+
+    def allow_host(self, subsystem, host):
+        '''
+        Grant the Host with NQN host access to the Subsystem with NQN
+        subsystem.  Both must exist.
+        '''
+        self._lookup(self.hosts, host, "Host")
+        s = self._lookup(self.subsystems, subsystem, "Subsystem")
+        if host not in s.allowed_hosts:
+            s.allowed_hosts.append(host)
+
+    def export(self, subsystem, portid):
+        '''
+        Export the Subsystem with NQN subsystem through the Port with Port
+        ID portid.  Both must exist.
+        '''
+        self._lookup(self.subsystems, subsystem, "Subsystem")
+        p = self._lookup(self.ports, int(portid), "Port")
+        if subsystem not in p.subsystems:
+            p.subsystems.append(subsystem)
+
+    def ports_exporting(self, nqn):
+        '''
+        @return: The sorted list of Port IDs exporting the Subsystem nqn.
+        '''
+        return sorted(p.portid for p in self.ports.values()
+                      if nqn in p.subsystems)
+
+    def subsystems_for_host(self, nqn):
+        '''
+        @return: The sorted list of Subsystem NQNs the Host nqn may
+            access, either explicitly or through allow_any_host.
+        '''
+        return sorted(s.nqn for s in self.subsystems.values()
+                      if nqn in s.allowed_hosts or
+                      str(s.get_attr('attr', 'allow_any_host')) == '1')
@@ -19,13 +19,26 @@ under the License.
 '''
 
 import os
+import functools
+import re
 import stat
+import threading
+import time
 import uuid
 import json
+from contextlib import contextmanager
+from fnmatch import fnmatch
 from glob import iglob as glob
-from six import iteritems, moves
+from itertools import islice
+from six import iteritems, moves, integer_types
+from .plan import RestorePlan, referral_mesh, stats_op, _groups, \
+    _priority
 
 DEFAULT_SAVE_FILE = '/etc/nvmet/config.json'
+DEFAULT_SAVE_DIR = '/etc/nvmet/config.d'
+DEFAULT_LOCK_DIR = '/run/nvmet'
+
+_DHCHAP_KEY = re.compile(r'^DHHC-1:0[0-3]:[A-Za-z0-9+/]+=*:$')
 
 
 class CFSError(Exception):
@@ -45,10 +58,100 @@ class CFSNotFound(CFSError):
     pass
 
 
+class Capabilities(object):
+    '''
+    Features of the loaded nvmet driver, probed once from configfs and
+    shared by all objects through CFSNode.capabilities.  A feature is None
+    as long as there was no object to probe it from, e.g. the Port
+    features before the first Port is created.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._features = {}
+        self._schemas = {}
+
+    def probe(self):
+        '''
+        Probe the features from the first existing Port and Subsystem.
+        '''
+        for name in os.listdir("%s/ports" % self.path)[:1]:
+            self.probe_port("%s/ports/%s" % (self.path, name))
+        for name in os.listdir("%s/subsystems" % self.path)[:1]:
+            self.probe_subsystem("%s/subsystems/%s" % (self.path, name))
+
+    def probe_port(self, path):
+        if 'ana' in self._features:
+            return
+        self._features['ana'] = os.path.isdir("%s/ana_groups" % path)
+        self._features['inline_data'] = \
+            os.path.isfile("%s/param_inline_data_size" % path)
+        self._features['pi'] = os.path.isfile("%s/param_pi_enable" % path)
+
+    def probe_subsystem(self, path):
+        if 'passthru' in self._features:
+            return
+        self._features['passthru'] = os.path.isdir("%s/passthru" % path)
+
+    ana = property(lambda self: self._features.get('ana'),
+                   doc="Are ANA Groups supported?")
+    inline_data = property(lambda self: self._features.get('inline_data'),
+                           doc="Can the Port inline data size be set?")
+    pi = property(lambda self: self._features.get('pi'),
+                  doc="Can Protection Information be enabled on Ports?")
+    passthru = property(lambda self: self._features.get('passthru'),
+                        doc="Are passthru Subsystems supported?")
+
+    def schema(self, node, group):
+        '''
+        @return: The sorted list of (name, writable) tuples of the
+            attributes in group of node, read once per object type.
+        '''
+        key = (node.__class__.__name__, group)
+        if key not in self._schemas:
+            schema = []
+            pattern = node._attr_path(group, '*')
+            for name in glob(pattern):
+                attr = name[len(pattern) - 1:]
+                if os.path.isfile(name) and attr != 'enable':
+                    s = os.stat(name)
+                    schema.append((attr, bool(s[stat.ST_MODE] & stat.S_IWUSR)))
+            self._schemas[key] = sorted(schema)
+        return self._schemas[key]
+
+
+@contextmanager
+def _no_lock():
+    yield
+
+
+def _locked(func):
+    '''
+    Decorator for methods that hold the lock of their object, see
+    CFSNode.lock().
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock():
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 class CFSNode(object):
 
     configfs_dir = '/sys/kernel/config/nvmet'
 
+    _capabilities = None
+
+    # Object with a record(op, node, seconds) method, e.g. an OpStats,
+    # that is told about every configfs operation while it is set
+    recorder = None
+
+    # Directory of the advisory locks taken by writers, None disables them
+    lock_dir = DEFAULT_LOCK_DIR
+
+    _locks = None
+
     def __init__(self):
         self._path = self.configfs_dir
         self._enable = None
@@ -63,6 +166,48 @@ class CFSNode(object):
     def _get_path(self):
         return self._path
 
+    def _get_capabilities(self):
+        caps = CFSNode._capabilities
+        if caps is None or caps.path != self.configfs_dir:
+            caps = Capabilities(self.configfs_dir)
+            caps.probe()
+            CFSNode._capabilities = caps
+        return caps
+
+    def _attr_path(self, group, attribute):
+        return "%s/%s_%s" % (self.path, str(group), str(attribute))
+
+    def _lock_key(self):
+        '''
+        @return: The (kind, name) of the object lock protecting this
+            object, or None if it needs the global lock.
+        '''
+        return None
+
+    def lock(self):
+        '''
+        Hold the advisory lock protecting this object for the duration of a
+        with block: the global lock for the Root, and the lock of the
+        Subsystem, Port or Host otherwise, see the lock module.  Methods
+        creating, linking, enabling or removing objects or changing more
+        than a single attribute take it themselves.
+        '''
+        if CFSNode.lock_dir is None:
+            return _no_lock()
+        locks = CFSNode._locks
+        if locks is None or locks.path != CFSNode.lock_dir:
+            from .lock import LockManager
+            locks = LockManager(CFSNode.lock_dir)
+            CFSNode._locks = locks
+        key = self._lock_key()
+        if key is None:
+            return locks.locked()
+        return locks.locked(*key)
+
+    def _record(self, op, start):
+        if CFSNode.recorder is not None:
+            CFSNode.recorder.record(op, self, time.time() - start)
+
     def _create_in_cfs(self, mode):
         '''
         Creates the configFS node if it does not already exist, depending on
@@ -81,11 +226,20 @@ class CFSNode(object):
                               (self.__class__.__name__, self.path))
 
         if not self.exists:
-            try:
-                os.mkdir(self.path)
-            except:
-                raise CFSError("Could not create %s in configFS" %
-                               self.__class__.__name__)
+            with self.lock():
+                # Another writer may have created it meanwhile
+                if self.exists:
+                    if mode == 'create':
+                        raise CFSError("This %s already exists in configFS" %
+                                       self.__class__.__name__)
+                else:
+                    start = time.time()
+                    try:
+                        os.mkdir(self.path)
+                    except:
+                        raise CFSError("Could not create %s in configFS" %
+                                       self.__class__.__name__)
+                    self._record('mkdir', start)
         self.get_enable()
 
     def _exists(self):
@@ -107,23 +261,8 @@ class CFSNode(object):
         '''
         self._check_self()
 
-        names = [os.path.basename(name).split('_', 1)[1]
-                 for name in glob("%s/%s_*" % (self._path, group))
-                     if os.path.isfile(name)]
-
-        if writable is True:
-            names = [name for name in names
-                     if self._attr_is_writable(group, name)]
-        elif writable is False:
-            names = [name for name in names
-                     if not self._attr_is_writable(group, name)]
-
-        names.sort()
-        return names
-
-    def _attr_is_writable(self, group, name):
-        s = os.stat("%s/%s_%s" % (self._path, group, name))
-        return s[stat.ST_MODE] & stat.S_IWUSR
+        return [name for name, w in self.capabilities.schema(self, group)
+                if writable is None or w == writable]
 
     def set_attr(self, group, attribute, value):
         '''
@@ -135,7 +274,7 @@ class CFSNode(object):
         @type value: string
         '''
         self._check_self()
-        path = "%s/%s_%s" % (self.path, str(group), str(attribute))
+        path = self._attr_path(group, attribute)
 
         if not os.path.isfile(path):
             raise CFSError("Cannot find attribute: %s" % path)
@@ -144,11 +283,13 @@ class CFSNode(object):
             raise CFSError("Cannot set attribute while %s is enabled" %
                            self.__class__.__name__)
 
+        start = time.time()
         try:
             with open(path, 'w') as file_fd:
                 file_fd.write(str(value))
         except Exception as e:
             raise CFSError("Cannot set attribute %s: %s" % (path, e))
+        self._record('write', start)
 
     def get_attr(self, group, attribute):
         '''
@@ -158,12 +299,15 @@ class CFSNode(object):
         @return: The named attribute's value, as a string.
         '''
         self._check_self()
-        path = "%s/%s_%s" % (self.path, str(group), str(attribute))
+        path = self._attr_path(group, attribute)
         if not os.path.isfile(path):
             raise CFSError("Cannot find attribute: %s" % path)
 
+        start = time.time()
         with open(path, 'r') as file_fd:
-            return file_fd.read().strip()
+            value = file_fd.read().strip()
+        self._record('read', start)
+        return value
 
     def get_enable(self):
         self._check_self()
@@ -171,10 +315,13 @@ class CFSNode(object):
         if not os.path.isfile(path):
             return None
 
+        start = time.time()
         with open(path, 'r') as file_fd:
             self._enable = int(file_fd.read().strip())
+        self._record('read', start)
         return self._enable
 
+    @_locked
     def set_enable(self, value):
         self._check_self()
         path = "%s/enable" % self.path
@@ -182,6 +329,7 @@ class CFSNode(object):
         if not os.path.isfile(path) or self._enable is None:
             raise CFSError("Cannot enable %s" % self.path)
 
+        start = time.time()
         try:
             with open(path, 'w') as file_fd:
                 file_fd.write(str(value))
@@ -189,7 +337,9 @@ class CFSNode(object):
             raise CFSError("Cannot enable %s: %s (%s)" %
                            (self.path, e, value))
         self._enable = value
+        self._record(stats_op('enable', value), start)
 
+    @_locked
     def delete(self):
         '''
         If the underlying configFS object does not exist, this method does
@@ -197,10 +347,14 @@ class CFSNode(object):
         to delete it.
         '''
         if self.exists:
+            start = time.time()
             os.rmdir(self.path)
+            self._record('rmdir', start)
 
     path = property(_get_path,
                     doc="Get the configFS object path.")
+    capabilities = property(_get_capabilities,
+                            doc="Get the Capabilities of the nvmet driver.")
     exists = property(_exists,
             doc="Is True as long as the underlying configFS object exists. "
                       + "If the underlying configFS objects gets deleted "
@@ -218,6 +372,28 @@ class CFSNode(object):
             d['enable'] = self._enable
         return d
 
+    def info(self, fields=None):
+        '''
+        Like dump(), but only for this object without its children, and
+        including the read-only attributes.
+        @param fields: If set, only these fields are read. A field is
+            either a key of the returned dict, like 'enable', or a single
+            attribute like 'addr.traddr'.
+        @return: A dict of the fields.
+        '''
+        d = {}
+        for group in self.attr_groups:
+            a = {}
+            for i in self.list_attrs(group):
+                if _wanted(fields, group) or \
+                        _wanted(fields, "%s.%s" % (group, i)):
+                    a[str(i)] = self.get_attr(group, i)
+            if a:
+                d[str(group)] = a
+        if _wanted(fields, 'enable') and self.get_enable() is not None:
+            d['enable'] = self._enable
+        return d
+
     def _setup_attrs(self, attr_dict, err_func):
         for group in self.attr_groups:
             for name, value in iteritems(attr_dict.get(group, {})):
@@ -243,6 +419,8 @@ class Root(CFSNode):
 
         self._path = self.configfs_dir
         self._create_in_cfs('lookup')
+        # Probe the driver features once, for all objects
+        self._get_capabilities()
 
     def _modprobe(self, modname):
         try:
@@ -278,6 +456,213 @@ class Root(CFSNode):
     ports = property(_list_ports,
                 doc="Get the list of Ports.")
 
+    def reconfigure_namespaces(self, changes, max_workers=8):
+        '''
+        Call Namespace.reconfigure() for many Namespaces in parallel.
+        @param changes: A list of (Namespace, changes) tuples.
+        @param max_workers: The maximum number of Namespaces reconfigured
+            at the same time.
+        @return: A list with the outage window in seconds of each
+            Namespace, or the CFSError it failed with, in the same order
+            as changes.
+        '''
+        return _run_parallel(lambda change: change[0].reconfigure(change[1]),
+                             changes, max_workers)
+
+    def rotate_host_keys(self, keys, max_workers=8):
+        '''
+        Set the DH-HMAC-CHAP keys of many Hosts in parallel, see
+        Host.set_keys().
+        @param keys: A dict mapping each Host NQN to the dict of
+            dhchap attributes to set, e.g. {'key': 'DHHC-1:00:...:'}.
+        @param max_workers: The maximum number of Hosts updated at the
+            same time.
+        @return: A dict mapping each Host NQN to None if its keys were
+            set, or the CFSError it failed with.
+        '''
+        nqns = sorted(keys)
+
+        def rotate(nqn):
+            Host(nqn, 'lookup').set_keys(keys[nqn])
+
+        return dict(zip(nqns, _run_parallel(rotate, nqns, max_workers)))
+
+    def find_namespaces(self, nqns=None, device=None, pattern=None):
+        '''
+        Select the enabled Namespaces by Subsystem and backing device.
+        @param nqns: Only return Namespaces of these Subsystem NQNs.
+        @param device: Only return Namespaces backed by this device, after
+            resolving symbolic links like /dev/disk/by-id/.
+        @param pattern: Only return Namespaces whose device path matches
+            this shell-style pattern, e.g. "/dev/vg0/*".
+        @return: A list of Namespace objects.
+        '''
+        if device is not None:
+            device = os.path.realpath(device)
+        namespaces = []
+        for s in self.subsystems:
+            if nqns is not None and s.nqn not in nqns:
+                continue
+            for ns in s.namespaces:
+                if not ns.get_enable():
+                    continue
+                path = ns.get_attr('device', 'path')
+                if device is not None and os.path.realpath(path) != device:
+                    continue
+                if pattern is not None and not fnmatch(path, pattern):
+                    continue
+                namespaces.append(ns)
+        return namespaces
+
+    def revalidate_namespaces(self, namespaces, max_workers=8):
+        '''
+        Call Namespace.revalidate_size() for many Namespaces in parallel.
+        @param namespaces: A list of Namespaces, e.g. from find_namespaces().
+        @param max_workers: The maximum number of Namespaces revalidated at
+            the same time.
+        @return: A list with the device size of each Namespace in bytes, or
+            the CFSError it failed with, in the same order as namespaces.
+        '''
+        return _run_parallel(lambda ns: ns.revalidate_size(), namespaces,
+                             max_workers)
+
+    def apply_port_profile(self, profile, adrfam=None, portids=None,
+                           max_workers=8, outages=None):
+        '''
+        Apply a port profile to all Ports of its transport type, see
+        Port.apply_profile().  The Ports are changed in rounds, each in
+        parallel, and Ports linked to the same Subsystem are never in the
+        same round, so that a Subsystem exported through several Ports
+        stays available through the others.
+        @param adrfam: Only apply it to Ports with this addr_adrfam.
+        @param portids: Only apply it to Ports whose ID is in this
+            collection, e.g. a range.
+        @param max_workers: The maximum number of Ports changed at the same
+            time.
+        @param outages: If a dict, the number of seconds each Subsystem
+            linked to a changed Port was exported through none of its
+            Ports is stored in it by NQN.
+        @return: A list of (Port, result) tuples, sorted by Port ID, where
+            result is the number of seconds the Port was unlinked, or the
+            CFSError it failed with.
+        '''
+        ports = self.find_ports(profile.get('trtype'), adrfam, portids)
+        links = dict((p.portid, p.subsystems) for p in self.ports)
+        exporting = {}
+        for portid, nqns in iteritems(links):
+            for nqn in nqns:
+                exporting[nqn] = exporting.get(nqn, 0) + 1
+
+        rounds = []
+        for p in ports:
+            nqns = set(links[p.portid])
+            for batch, linked in rounds:
+                if not nqns & linked:
+                    batch.append(p)
+                    linked |= nqns
+                    break
+            else:
+                rounds.append(([p], nqns))
+
+        results = {}
+        for batch, linked in rounds:
+            for p, result in zip(batch, _run_parallel(
+                    lambda p: p.apply_profile(profile), batch, max_workers)):
+                results[p.portid] = result
+
+        if outages is not None:
+            for p in ports:
+                window = results[p.portid]
+                for nqn in links[p.portid]:
+                    if exporting[nqn] > 1 or isinstance(window, CFSError):
+                        outages.setdefault(nqn, 0.0)
+                    else:
+                        outages[nqn] = outages.get(nqn, 0.0) + window
+        return [(p, results[p.portid]) for p in ports]
+
+    def plan_referral_mesh(self, peers, trtype=None, prune=True):
+        '''
+        Plan the configfs operations that make every Port refer to all
+        other Ports of the cluster, see plan.referral_mesh().  Only
+        referrals that differ are changed.
+        @param peers: The Ports of the other cluster nodes, as in the
+            'ports' list of a saved configuration.
+        @return: A RestorePlan.
+        '''
+        ports = [p.dump() for p in self.ports]
+        return RestorePlan({'ports': referral_mesh(ports, peers, trtype,
+                                                   prune)},
+                           {'ports': ports})
+
+    @_locked
+    def apply_referral_mesh(self, peers, trtype=None, prune=True,
+                            abort_on_error=False):
+        '''
+        Set up the referral mesh planned by plan_referral_mesh() in one
+        pass.
+        @return: The list of non-fatal errors, see execute_plan().
+        '''
+        return self.execute_plan(self.plan_referral_mesh(peers, trtype,
+                                                         prune),
+                                 abort_on_error)
+
+    def find_ports(self, trtype=None, adrfam=None, portids=None):
+        '''
+        Select Ports by transport type, address family and Port ID.
+        @param trtype: Only return Ports with this addr_trtype.
+        @param adrfam: Only return Ports with this addr_adrfam.
+        @param portids: Only return Ports whose ID is in this collection,
+            e.g. a range.
+        @return: A list of Port objects, sorted by Port ID.
+        '''
+        ports = []
+        for p in self.ports:
+            if portids is not None and p.portid not in portids:
+                continue
+            if trtype is not None and p.get_attr('addr', 'trtype') != trtype:
+                continue
+            if adrfam is not None and p.get_attr('addr', 'adrfam') != adrfam:
+                continue
+            ports.append(p)
+        ports.sort(key=lambda p: p.portid)
+        return ports
+
+    @_locked
+    def export_subsystems(self, nqns, trtype=None, adrfam=None, portids=None,
+                          trtype_order=None):
+        '''
+        Link all Subsystems in I{nqns} to every Port selected by I{trtype},
+        I{adrfam} and I{portids} (see find_ports()), skipping the links that
+        already exist.
+        @param trtype_order: An optional sequence of transport types, e.g.
+            ('rdma', 'tcp').  Ports are linked one at a time in this
+            transport order, so hosts find their preferred transport first
+            instead of connecting to a fallback and reconnecting later.
+            Ports with other transport types go last.
+        @return: The list of (portid, nqn) tuples that were linked.
+        '''
+        nqns = list(nqns)
+        ports = self.find_ports(trtype, adrfam, portids)
+        if trtype_order:
+            trtype_order = list(trtype_order)
+
+            def rank(p):
+                t = p.get_attr('addr', 'trtype')
+                if t in trtype_order:
+                    return trtype_order.index(t)
+                return len(trtype_order)
+            ports.sort(key=rank)
+
+        linked = []
+        for p in ports:
+            present = set(p.subsystems)
+            for nqn in nqns:
+                if nqn not in present:
+                    p.add_subsystem(nqn)
+                    present.add(nqn)
+                    linked.append((p.portid, nqn))
+        return linked
+
     def _list_hosts(self):
         self._check_self()
 
@@ -287,38 +672,167 @@ class Root(CFSNode):
     hosts = property(_list_hosts,
                      doc="Get the list of Hosts.")
 
-    def save_to_file(self, savefile=None):
+    @_locked
+    def sync_allowed_hosts(self, acl, by_host=False, create_hosts=True):
+        '''
+        Make the allowed_hosts of many Subsystems match a desired ACL, only
+        creating and removing the links that differ.
+        @param acl: A dict mapping each Subsystem NQN to the iterable of
+            Host NQNs allowed to access it.  Subsystems not in the dict
+            are left alone.
+        @param by_host: If True, I{acl} maps each Host NQN to the iterable
+            of Subsystem NQNs it may access instead.  Hosts not in the dict
+            keep their current access.
+        @param create_hosts: Create missing Host objects if True, fail
+            otherwise.
+        @return: A tuple with the number of links added and removed.
+        '''
+        self._check_self()
+
+        if by_host:
+            managed = set(acl)
+            wanted = {}
+            for host, nqns in iteritems(acl):
+                for nqn in nqns:
+                    wanted.setdefault(nqn, set()).add(host)
+            targets = os.listdir("%s/subsystems/" % self._path)
+        else:
+            managed = None
+            wanted = dict((nqn, set(hosts)) for nqn, hosts in iteritems(acl))
+            targets = list(wanted)
+
+        # Look up every Subsystem before the first change, so that an
+        # unknown NQN leaves the ACL untouched
+        existing = set(os.listdir("%s/subsystems/" % self._path))
+        unknown = set(wanted) - existing
+        if unknown:
+            raise CFSNotFound("No such Subsystem in configfs: %s" %
+                              ", ".join(sorted(unknown)))
+        subsystems = [Subsystem(nqn, 'lookup') for nqn in targets]
+
+        missing = set()
+        for hosts in wanted.values():
+            missing |= hosts
+        missing -= set(os.listdir("%s/hosts/" % self._path))
+        if missing and not create_hosts:
+            raise CFSError("Hosts not defined: %s" %
+                           ", ".join(sorted(missing)))
+        for nqn in sorted(missing):
+            Host(nqn, 'create')
+
+        added = removed = 0
+        for s in subsystems:
+            desired = wanted.get(s.nqn, set())
+            if managed is not None:
+                desired = desired | (set(s.allowed_hosts) - managed)
+            a, r = s.set_allowed_hosts(desired)
+            added += len(a)
+            removed += len(r)
+        return added, removed
+
+    def access_index(self):
+        '''
+        Build the reverse indexes of which Ports export each Subsystem and
+        which Subsystems each Host may access in one pass over configfs.
+        @return: An AccessIndex object.
+        '''
+        return AccessIndex(self)
+
+    @_locked
+    def save_to_file(self, savefile=None, history=None, max_workers=None):
         '''
-        Write the configuration in json format to a file.
+        Write the configuration in json format to a file.  If savefile is
+        a directory (or ends with a slash) the configuration is saved as
+        one file per object, see save_to_dir().  If history is a History,
+        a snapshot of the saved configuration is added to it.  If
+        max_workers is set, the configuration is read on up to max_workers
+        threads, see dump().
         '''
         if savefile:
             savefile = os.path.expanduser(savefile)
         else:
             savefile = DEFAULT_SAVE_FILE
 
+        if os.path.isdir(savefile) or savefile.endswith(os.sep):
+            self.save_to_dir(savefile, history, max_workers)
+            return
+
         savefile_abspath = os.path.abspath(savefile)
         savefile_dir = os.path.dirname(savefile_abspath)
         if not os.path.exists(savefile_dir):
             os.makedirs(savefile_dir)
 
-        with open(savefile + ".temp", "w+") as f:
-            os.fchmod(f.fileno(), stat.S_IRUSR | stat.S_IWUSR)
-            f.write(json.dumps(self.dump(), sort_keys=True, indent=2))
-            f.write("\n")
-            f.flush()
-            os.fsync(f.fileno())
-
-        os.rename(savefile + ".temp", savefile)
+        config = self.dump(max_workers)
+        _keep_metadata(config, savefile)
+        _write_file(savefile, _config_to_json(config))
 
         # Sync the containing directory too
-        dir_fd = None
-        try:
-            dir_fd = os.open(savefile_dir, os.O_RDONLY)
-            os.fsync(dir_fd)
-        finally:
-            if dir_fd:
-                os.close(dir_fd)
+        _sync_dir(savefile_dir)
+
+        if history is not None:
+            history.snapshot(config)
 
+    @_locked
+    def save_to_dir(self, savedir=None, history=None, max_workers=None):
+        '''
+        Write the configuration in json format to a directory, with one
+        file per Subsystem and Port and one for the Hosts.  Only the files
+        whose content changed are rewritten, and files of objects that no
+        longer exist are removed.  Saving to the default directory removes
+        the default file, which would otherwise be restored instead.  If
+        history is a History, a snapshot of the saved configuration is
+        added to it.  max_workers is passed to dump().
+        Returns the list of file names that were written or removed.
+        '''
+        if savedir:
+            savedir = os.path.expanduser(savedir)
+        else:
+            savedir = DEFAULT_SAVE_DIR
+
+        if not os.path.exists(savedir):
+            os.makedirs(savedir)
+
+        config = self.dump(max_workers)
+        _keep_metadata(config, savedir)
+        shards = {'hosts.json': {'hosts': config['hosts']}}
+        if config.get('port_profiles'):
+            shards['profiles.json'] = {
+                'port_profiles': config['port_profiles']}
+        for s in config['subsystems']:
+            shards['subsystem-%s.json' % s['nqn']] = {'subsystems': [s]}
+        for p in config['ports']:
+            shards['port-%d.json' % p['portid']] = {'ports': [p]}
+
+        changed = []
+        for name, shard in iteritems(shards):
+            path = os.path.join(savedir, name)
+            data = _config_to_json(shard)
+            try:
+                with open(path, "r") as f:
+                    if f.read() == data:
+                        continue
+            except IOError:
+                pass
+            _write_file(path, data)
+            changed.append(name)
+
+        for name in os.listdir(savedir):
+            if name not in shards and _is_shard(name):
+                os.unlink(os.path.join(savedir, name))
+                changed.append(name)
+
+        if changed:
+            _sync_dir(savedir)
+
+        if os.path.abspath(savedir) == os.path.abspath(DEFAULT_SAVE_DIR) \
+                and os.path.exists(DEFAULT_SAVE_FILE):
+            os.unlink(DEFAULT_SAVE_FILE)
+            _sync_dir(os.path.dirname(os.path.abspath(DEFAULT_SAVE_FILE)))
+        if history is not None:
+            history.snapshot(config)
+        return sorted(changed)
+
+    @_locked
     def clear_existing(self):
         '''
         Remove entire current configuration.
@@ -331,14 +845,164 @@ class Root(CFSNode):
         for h in self.hosts:
             h.delete()
 
-    def restore(self, config, clear_existing=False, abort_on_error=False):
+    def plan_restore(self, config, clear_existing=False, diff=False):
+        '''
+        Takes a dict generated by dump() and returns a RestorePlan with the
+        configfs operations restore() would perform, without changing
+        anything.  If diff is True, only the operations needed to turn the
+        live configuration into config are planned.
+        '''
+        live = None
+        if clear_existing or diff:
+            live = self.dump()
+        return RestorePlan(config, live, clear_existing and not diff)
+
+    @_locked
+    def execute_plan(self, plan, abort_on_error=False):
+        '''
+        Perform the configfs operations of a RestorePlan in order.
+        Returns the list of non-fatal errors, or raises the first error
+        if abort_on_error is set.
+        '''
+        self._check_self()
+        errors = []
+        for op, path, value in plan:
+            path = os.path.join(self.path, path)
+            start = time.time()
+            try:
+                if op == 'mkdir':
+                    os.mkdir(path)
+                elif op == 'rmdir':
+                    os.rmdir(path)
+                elif op == 'symlink':
+                    os.symlink(os.path.join(self.path, value), path)
+                elif op == 'unlink':
+                    os.unlink(path)
+                else:
+                    with open(path, 'w') as file_fd:
+                        file_fd.write(str(value))
+            except (IOError, OSError) as e:
+                err_str = "Could not %s %s: %s" % (op, path, e)
+                if abort_on_error:
+                    raise CFSError(err_str)
+                errors.append(err_str + ", skipped")
+                continue
+            self._record(stats_op(op, value), start)
+        return errors
+
+    @_locked
+    def apply_changes(self, config, abort_on_error=False, stats=None):
+        '''
+        Takes a dict generated by dump() and reconfigures the target to
+        match, like restore() with clear_existing, but only the objects
+        and attributes that differ are changed, e.g. to roll back to a
+        snapshot of a History.  Objects that don't change stay online.
+        The config is checked with validate_config() first.
+        Returns the list of non-fatal errors.
+        '''
+        errors = validate_config(config)
+        if errors:
+            raise CFSError("Invalid configuration, not applying:\n%s" %
+                           "\n".join(errors))
+
+        CFSNode.recorder = stats
+        try:
+            return self.execute_plan(self.plan_restore(config, diff=True),
+                                     abort_on_error)
+        finally:
+            CFSNode.recorder = None
+
+    @_locked
+    def restore(self, config, clear_existing=False, abort_on_error=False,
+                stats=None, validate=True, journal=None, available=None,
+                report=None):
         '''
         Takes a dict generated by dump() and reconfigures the target to match.
         Returns list of non-fatal errors that were encountered.
         Will refuse to restore over an existing configuration unless
         clear_existing is True.
+        Unless validate is False, the whole config is checked with
+        validate_config() first, and nothing is changed if it is invalid.
+        If stats is an OpStats object, the latency of each configfs
+        operation is recorded in it.
+        If journal is a RestoreJournal, the completed Namespaces,
+        Subsystems and Ports are recorded in it.  If it belongs to an
+        interrupted restore of the same config, that restore is continued
+        instead: the existing configuration is kept apart from unfinished
+        Ports, and, if clear_existing is True, the objects not in config.
+        The Ports are set up first, then the Subsystems in order of
+        priority, see _priority(), each linked to its Ports as soon as it
+        is set up.  If available is a dict, the number of
+        seconds after the start of the restore at which each Subsystem
+        was linked to all its Ports is stored in it by NQN.
+        If report is a Report, every configfs operation and error is
+        recorded in it by object, and passed on to stats.
         '''
+        if validate:
+            errors = validate_config(config)
+            if errors:
+                err_str = "Invalid configuration, not restoring:\n%s" % \
+                    "\n".join(errors)
+                if report is not None:
+                    report.start()
+                    report.error(err_str)
+                    report.finish()
+                raise CFSError(err_str)
+
+        CFSNode.recorder = stats
+        if report is not None:
+            if stats is not None:
+                report.stats = stats
+            if available is None:
+                available = {}
+            CFSNode.recorder = report
+            report.start()
+        if journal is not None:
+            journal.open(config)
+        try:
+            errors = self._restore(config, clear_existing, abort_on_error,
+                                   journal, available, report)
+            if journal is not None:
+                journal.finish()
+            return errors
+        except CFSError as e:
+            if report is not None:
+                report.error(str(e))
+            raise
+        finally:
+            CFSNode.recorder = None
+            if report is not None:
+                report.finish(available, journal)
+            if journal is not None:
+                journal.close()
+
+    def _clear_for_resume(self, config, clear_existing, journal):
+        nqns = set(t['nqn'] for t in config.get('subsystems', []))
+        hosts = set(t['nqn'] for t in config.get('hosts', []))
+        portids = set(int(t['portid']) for t in config.get('ports', []))
+
+        # Unfinished Ports are set up again from scratch.  The links of
+        # all Ports are redone with their Subsystems, keeping existing ones
+        for p in self.ports:
+            if p.portid in portids:
+                if not journal.done("ports/%s" % p.portid):
+                    p.delete()
+            elif clear_existing:
+                p.delete()
         if clear_existing:
+            for s in self.subsystems:
+                if s.nqn not in nqns:
+                    s.delete()
+            for h in self.hosts:
+                if h.nqn not in hosts:
+                    h.delete()
+
+    def _restore(self, config, clear_existing, abort_on_error, journal=None,
+                 available=None, report=None):
+        start = time.time()
+        if journal is not None and journal.resumed:
+            self._clear_for_resume(config, clear_existing, journal)
+        elif clear_existing:
             self.clear_existing()
         else:
             if any(self.subsystems):
@@ -352,56 +1016,601 @@ class Root(CFSNode):
         else:
             def err_func(err_str):
                 errors.append(err_str + ", skipped")
+                if report is not None:
+                    report.error(err_str)
+
+        def begin(path):
+            if report is not None:
+                report.begin(path)
 
         # Create the hosts first because the subsystems reference them
         for index, t in enumerate(config.get('hosts', [])):
+            begin(None)
             if 'nqn' not in t:
                 err_func("'nqn' not defined in host %d" % index)
                 continue
 
+            begin("hosts/%s" % t['nqn'])
             Host.setup(t, err_func)
 
+        # The Ports are set up before the Subsystems but linked to each of
+        # them only once it is set up, so that every Subsystem is exported
+        # as soon as it is ready instead of after the whole config
+        links = {}
+        for index, t in enumerate(config.get('ports', [])):
+            begin(None)
+            if 'portid' not in t:
+                err_func("'portid' not defined in port %d" % index)
+                continue
+
+            begin("ports/%s" % t['portid'])
+            _journaled(journal, "ports/%s" % t['portid'], err_func,
+                       functools.partial(Port.setup, link=False), self, t)
+            for nqn in t.get('subsystems', []):
+                links.setdefault(nqn, []).append(t['portid'])
+
+        begin(None)
+        subsystems = []
         for index, t in enumerate(config.get('subsystems', [])):
             if 'nqn' not in t:
                 err_func("'nqn' not defined in subsystem %d" % index)
                 continue
+            subsystems.append(t)
+        subsystems.sort(key=_priority, reverse=True)
+
+        ports = {}
+        for t in subsystems:
+            begin("subsystems/%s" % t['nqn'])
+            _journaled(journal, "subsystems/%s" % t['nqn'], err_func,
+                       functools.partial(Subsystem.setup, journal=journal), t)
+            self._link_subsystem(t['nqn'], links.pop(t['nqn'], []), ports,
+                                 err_func)
+            if available is not None:
+                available[t['nqn']] = time.time() - start
+        # Links to Subsystems that are not in the config
+        for nqn, portids in sorted(iteritems(links)):
+            begin("subsystems/%s" % nqn)
+            self._link_subsystem(nqn, portids, ports, err_func)
 
-            Subsystem.setup(t, err_func)
+        return errors
 
-        for index, t in enumerate(config.get('ports', [])):
-            if 'portid' not in t:
-                err_func("'portid' not defined in port %d" % index)
+    def _link_subsystem(self, nqn, portids, ports, err_func):
+        '''
+        Link the Subsystem I{nqn} to the Ports I{portids}, unless it already
+        is.  I{ports} caches the Port objects and their links by Port ID.
+        '''
+        for portid in portids:
+            if portid not in ports:
+                try:
+                    port = Port(portid, 'lookup')
+                except CFSNotFound:
+                    # Setting up the Port failed, that was reported
+                    ports[portid] = None
+                    continue
+                ports[portid] = (port, set(port.subsystems))
+            if ports[portid] is None:
                 continue
 
-            Port.setup(self, t, err_func)
-
-        return errors
+            port, linked = ports[portid]
+            if nqn not in linked:
+                try:
+                    port.add_subsystem(nqn)
+                except CFSError as e:
+                    err_func(str(e))
+                    continue
+                linked.add(nqn)
 
     def restore_from_file(self, savefile=None, clear_existing=True,
-                          abort_on_error=False):
+                          abort_on_error=False, stats=None, journal=None):
         '''
-        Restore the configuration from a file in json format.
+        Restore the configuration from a file in json format, or from a
+        directory written by save_to_dir().  Without a savefile, the
+        default file is used, see load_config().
         Returns a list of non-fatal errors. If abort_on_error is set,
           it will raise the exception instead of continuing.
         '''
-        if savefile:
-            savefile = os.path.expanduser(savefile)
-        else:
-            savefile = DEFAULT_SAVE_FILE
-
-        with open(savefile, "r") as f:
-            config = json.loads(f.read())
-            return self.restore(config, clear_existing=clear_existing,
-                                abort_on_error=abort_on_error)
+        config = load_config(savefile)
+        return self.restore(config, clear_existing=clear_existing,
+                            abort_on_error=abort_on_error, stats=stats,
+                            journal=journal)
 
-    def dump(self):
+    def walk(self, path=None, depth=None):
+        '''
+        Walk the objects in configFS in a stable order, without reading
+        their attributes.
+        @param path: Only walk the objects at or below this path relative
+            to the configFS root, e.g. "subsystems/<nqn>" or "ports".
+        @param depth: If set, only walk objects up to this nesting level,
+            1 being Subsystems, Ports and Hosts and 2 their Namespaces,
+            ANA Groups and Referrals.
+        @return: A generator of (path, type, object) tuples.
+        '''
+        self._check_self()
+        parts = [p for p in (path or '').split('/') if p]
+        if parts and parts[0] not in _TOP_COLLECTIONS:
+            raise CFSNotFound("No such path in configfs: %s" % path)
+        for collection in _TOP_COLLECTIONS:
+            if not parts or parts[0] == collection:
+                for t in _walk(self, collection, collection, parts[1:], 1,
+                               depth):
+                    yield t
+
+    def list_objects(self, path=None, depth=None, fields=None, offset=0,
+                     limit=None):
+        '''
+        Describe the objects in configFS one at a time, see walk().  Only
+        the objects in the requested page are read.
+        @param fields: If set, the fields to read, see CFSNode.info().
+        @param offset: The number of objects to skip.
+        @param limit: If set, the maximum number of objects returned.
+        @return: A generator of the CFSNode.info() dicts of the objects,
+            with their 'path' and 'type' added.
+        '''
+        if limit is not None:
+            limit += offset
+        for path, kind, node in islice(self.walk(path, depth), offset, limit):
+            d = node.info(fields)
+            d['path'] = path
+            d['type'] = kind
+            yield d
+
+    def dump(self, max_workers=None):
+        '''
+        @param max_workers: If set, the Subsystems, Ports and Hosts are read
+            on up to max_workers threads.  The result is the same either
+            way.
+        '''
         d = super(Root, self).dump()
-        d['subsystems'] = [s.dump() for s in self.subsystems]
-        d['ports'] = [p.dump() for p in self.ports]
-        d['hosts'] = [h.dump() for h in self.hosts]
+        subsystems = list(self.subsystems)
+        ports = list(self.ports)
+        hosts = list(self.hosts)
+        nodes = subsystems + ports + hosts
+        if max_workers is None or max_workers < 2:
+            dumps = [n.dump() for n in nodes]
+        else:
+            def dump(node):
+                try:
+                    return node.dump()
+                except Exception as e:
+                    return e
+            dumps = _run_parallel(dump, nodes, max_workers)
+            for obj in dumps:
+                if isinstance(obj, Exception):
+                    raise obj
+        d['subsystems'] = dumps[:len(subsystems)]
+        d['ports'] = dumps[len(subsystems):len(subsystems) + len(ports)]
+        d['hosts'] = dumps[len(subsystems) + len(ports):]
         return d
 
 
+def _run_parallel(func, items, max_workers):
+    '''
+    Call func for each of items on up to max_workers threads.
+    @return: The list of what func returned for each item, or the CFSError
+        it raised, in the same order as items.
+    '''
+    results = [None] * len(items)
+    jobs = moves.queue.Queue()
+    for index, item in enumerate(items):
+        jobs.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = jobs.get_nowait()
+            except moves.queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except CFSError as e:
+                results[index] = e
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max_workers, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _journaled(journal, step, err_func, setup, *args):
+    '''
+    Call setup(*args, err_func=err_func), unless the journal has
+    I{step} as completed and its object still exists.  The step is
+    recorded as completed if setup reports no error.
+    '''
+    if journal is None:
+        setup(*args, err_func=err_func)
+        return
+    if journal.done(step) and \
+            os.path.isdir("%s/%s" % (CFSNode.configfs_dir, step)):
+        journal.skipped += 1
+        return
+
+    errors = []
+
+    def step_err_func(err_str):
+        errors.append(err_str)
+        err_func(err_str)
+
+    setup(*args, err_func=step_err_func)
+    if not errors:
+        journal.checkpoint(step)
+
+
+def _keep_metadata(config, path):
+    '''
+    Priorities and port profiles don't exist in configfs, copy them into
+    config from the saved configuration at path, if there is one.
+    '''
+    try:
+        old = load_config(path)
+    except (IOError, OSError, ValueError):
+        return
+
+    if old.get('port_profiles'):
+        config['port_profiles'] = old['port_profiles']
+
+    old_subsystems = dict((t.get('nqn'), t) for t in old.get('subsystems', []))
+    for t in config.get('subsystems', []):
+        old_t = old_subsystems.get(t['nqn'])
+        if old_t is None:
+            continue
+        if 'priority' in old_t:
+            t['priority'] = old_t['priority']
+        old_ns = dict((str(n.get('nsid')), n)
+                      for n in old_t.get('namespaces', []))
+        for n in t.get('namespaces', []):
+            priority = old_ns.get(str(n['nsid']), {}).get('priority')
+            if priority is not None:
+                n['priority'] = priority
+
+
+def _wanted(fields, name):
+    return fields is None or name in fields
+
+
+def _walk(parent, path, collection, parts, level, depth):
+    kind, lookup, numeric, children = _COLLECTIONS[collection]
+    if parts:
+        names = [parts[0]]
+    else:
+        dirpath = "%s/%s" % (parent.path, collection)
+        if not os.path.isdir(dirpath):
+            return
+        names = sorted(os.listdir(dirpath), key=int if numeric else None)
+    if len(parts) > 1 and parts[1] not in children:
+        raise CFSNotFound("No such path in configfs: %s/%s/%s" %
+                          (path, parts[0], parts[1]))
+
+    for name in names:
+        node = lookup(parent, name)
+        node_path = "%s/%s" % (path, name)
+        if len(parts) < 2:
+            yield (node_path, kind, node)
+        if depth is not None and level >= depth:
+            continue
+        for child in children:
+            if len(parts) < 2 or parts[1] == child:
+                for t in _walk(node, "%s/%s" % (node_path, child), child,
+                               parts[2:], level + 1, depth):
+                    yield t
+
+
+def _config_to_json(config):
+    return json.dumps(config, sort_keys=True, indent=2) + "\n"
+
+
+def _write_file(path, data):
+    '''
+    Atomically replace the file at path with data, synced to disk.
+    '''
+    with open(path + ".temp", "w+") as f:
+        os.fchmod(f.fileno(), stat.S_IRUSR | stat.S_IWUSR)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(path + ".temp", path)
+
+
+def _device_size(path):
+    '''
+    @return: The size in bytes of the block device or file at path.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            return f.tell()
+    except (IOError, OSError) as e:
+        raise CFSError("Cannot read the size of %s: %s" % (path, e))
+
+
+def _sync_dir(path):
+    dir_fd = None
+    try:
+        dir_fd = os.open(path, os.O_RDONLY)
+        os.fsync(dir_fd)
+    finally:
+        if dir_fd:
+            os.close(dir_fd)
+
+
+def _is_shard(name):
+    return name in ('hosts.json', 'profiles.json') or \
+        (name.endswith('.json') and
+        (name.startswith('subsystem-') or name.startswith('port-')))
+
+
+def _merge_configs(configs):
+    '''
+    Merge a list of config dicts into one.  Hosts, Subsystems and Ports
+    with the same NQN or Port ID as an earlier one replace it.
+    '''
+    merged = {}
+    for kind, key in (('hosts', 'nqn'), ('subsystems', 'nqn'),
+                      ('ports', 'portid'), ('port_profiles', 'name')):
+        objs = []
+        index = {}
+        for config in configs:
+            for obj in config.get(kind, []):
+                if key in obj and obj[key] in index:
+                    objs[index[obj[key]]] = obj
+                    continue
+                if key in obj:
+                    index[obj[key]] = len(objs)
+                objs.append(obj)
+        if objs or kind != 'port_profiles':
+            merged[kind] = objs
+    return merged
+
+
+def load_config(savefile=None):
+    '''
+    Read a configuration in json format from a file, or merge all the
+    files of a directory written by Root.save_to_dir().  Without a
+    savefile, the default file is read, or the default directory if
+    there is no default file.
+    Returns the configuration dict.
+    '''
+    if savefile:
+        path = os.path.expanduser(savefile)
+    elif os.path.exists(DEFAULT_SAVE_FILE) or \
+            not os.path.isdir(DEFAULT_SAVE_DIR):
+        path = DEFAULT_SAVE_FILE
+    else:
+        path = DEFAULT_SAVE_DIR
+
+    if not os.path.isdir(path):
+        with open(path, "r") as f:
+            return json.loads(f.read())
+
+    configs = []
+    for name in sorted(os.listdir(path)):
+        if _is_shard(name):
+            with open(os.path.join(path, name), "r") as f:
+                configs.append(json.loads(f.read()))
+    return _merge_configs(configs)
+
+
+def _check_id(errors, what, value, low, high):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        errors.append("%s %r is not a number" % (what, value))
+        return None
+    if value < low or value > high:
+        errors.append("%s %d must be %d to %d" % (what, value, low, high))
+    return value
+
+
+def _check_priority(errors, what, t):
+    priority = t.get('priority', 0)
+    if not isinstance(priority, integer_types) or isinstance(priority, bool):
+        errors.append("Priority %r of %s is not an integer" % (priority, what))
+
+
+def validate_config(config):
+    '''
+    Check a whole configuration dict generated by dump() before touching
+    configfs: missing, duplicate or out of range NQNs, NSIDs, Port IDs and
+    ANA Group IDs, allowed_hosts and Port links that reference undefined
+    Hosts or Subsystems, Namespaces in undefined ANA Groups, Ports
+    sharing the same transport address, priorities that aren't integers,
+    enabled passthru without a device or next to Namespaces, and invalid
+    port profiles.
+    Returns the list of problems found, which is empty if the
+    configuration is valid.
+    '''
+    errors = []
+
+    hosts = set()
+    for index, t in enumerate(config.get('hosts', [])):
+        if 'nqn' not in t:
+            errors.append("'nqn' not defined in host %d" % index)
+        elif t['nqn'] in hosts:
+            errors.append("Host %s defined twice" % t['nqn'])
+        else:
+            hosts.add(t['nqn'])
+
+    subsystems = set()
+    for index, t in enumerate(config.get('subsystems', [])):
+        if 'nqn' not in t:
+            errors.append("'nqn' not defined in subsystem %d" % index)
+        elif t['nqn'] in subsystems:
+            errors.append("Subsystem %s defined twice" % t['nqn'])
+        else:
+            subsystems.add(t['nqn'])
+
+    # ANA Group 1 always exists, 0 means ANA is not supported
+    grpids = set([0, 1])
+    addrs = {}
+    portids = set()
+    for index, t in enumerate(config.get('ports', [])):
+        if 'portid' not in t:
+            errors.append("'portid' not defined in port %d" % index)
+            continue
+        portid = _check_id(errors, "Port ID", t['portid'], 0,
+                           Port.MAX_PORTID)
+        if portid in portids:
+            errors.append("Port %d defined twice" % portid)
+        portids.add(portid)
+        what = "port %s" % t['portid']
+
+        for nqn in t.get('subsystems', []):
+            if nqn not in subsystems:
+                errors.append("Subsystem %s of %s not defined" % (nqn, what))
+
+        port_grpids = set()
+        for a in t.get('ana_groups', []):
+            if 'grpid' not in a:
+                errors.append("'grpid' not defined in ANA group of %s" %
+                              what)
+                continue
+            grpid = _check_id(errors, "ANA Group ID", a['grpid'], 1,
+                              ANAGroup.MAX_GRPID)
+            if grpid in port_grpids:
+                errors.append("ANA Group %d of %s defined twice" %
+                              (grpid, what))
+            port_grpids.add(grpid)
+        grpids |= port_grpids
+
+        names = set()
+        for r in t.get('referrals', []):
+            if 'name' not in r:
+                errors.append("'name' not defined in referral of %s" % what)
+            elif r['name'] in names:
+                errors.append("Referral %s of %s defined twice" %
+                              (r['name'], what))
+            else:
+                names.add(r['name'])
+
+        addr = t.get('addr', {})
+        if addr.get('traddr'):
+            key = tuple(str(addr.get(name)) for name in
+                        ('trtype', 'adrfam', 'traddr', 'trsvcid'))
+            if key in addrs:
+                errors.append("%s uses the same address as port %s" %
+                              (what.capitalize(), addrs[key]))
+            else:
+                addrs[key] = t['portid']
+
+    for t in config.get('subsystems', []):
+        what = "subsystem %s" % t.get('nqn')
+        _check_priority(errors, what, t)
+        passthru = t.get('passthru')
+        if passthru is not None and passthru.get('enable'):
+            if not passthru.get('device_path'):
+                errors.append("Passthru of %s enabled without a "
+                              "device_path" % what)
+            if t.get('namespaces'):
+                errors.append("Passthru of %s enabled but it has "
+                              "namespaces" % what)
+        for nqn in t.get('allowed_hosts', []):
+            if nqn not in hosts:
+                errors.append("Allowed host %s of %s not defined" %
+                              (nqn, what))
+
+        nsids = set()
+        for n in t.get('namespaces', []):
+            if 'nsid' not in n:
+                errors.append("'nsid' not defined in namespace of %s" % what)
+                continue
+            nsid = _check_id(errors, "NSID", n['nsid'], 1, Namespace.MAX_NSID)
+            if nsid in nsids:
+                errors.append("NSID %d of %s defined twice" % (nsid, what))
+            nsids.add(nsid)
+            _check_priority(errors, "namespace %s of %s" % (n['nsid'], what),
+                            n)
+
+            for grpid in (n.get('ana_grpid'), n.get('ana', {}).get('grpid')):
+                try:
+                    grpid = int(grpid)
+                except (TypeError, ValueError):
+                    continue
+                if grpid not in grpids:
+                    errors.append("ANA Group %d of namespace %s of %s not "
+                                  "defined" % (grpid, n['nsid'], what))
+                    break
+
+    names = set()
+    for index, t in enumerate(config.get('port_profiles', [])):
+        if 'name' not in t:
+            errors.append("'name' not defined in port profile %d" % index)
+            continue
+        what = "port profile %s" % t['name']
+        if t['name'] in names:
+            errors.append("Port profile %s defined twice" % t['name'])
+        names.add(t['name'])
+        if not t.get('trtype'):
+            errors.append("'trtype' not defined in %s" % what)
+        version = t.get('version', 0)
+        if not isinstance(version, integer_types) or \
+                isinstance(version, bool):
+            errors.append("Version %r of %s is not an integer" %
+                          (version, what))
+        if 'addr' in t:
+            errors.append("Addresses can't be set by %s" % what)
+
+    return errors
+
+
+class AccessIndex(object):
+    '''
+    Reverse indexes over a snapshot of the configFS hierarchy, answering
+    which Ports export a Subsystem and which Subsystems a Host can reach
+    without walking every Port and Subsystem per query.  Build it with
+    Root.access_index() and rebuild it after the configuration changes.
+    '''
+
+    def __init__(self, root):
+        self._exports = {}
+        self._allowed = {}
+        self._any_host = set()
+
+        for s in root.subsystems:
+            if s.get_attr('attr', 'allow_any_host') == '1':
+                self._any_host.add(s.nqn)
+            for h in s.allowed_hosts:
+                self._allowed.setdefault(h, set()).add(s.nqn)
+
+        for p in root.ports:
+            for nqn in p.subsystems:
+                self._exports.setdefault(nqn, []).append(p.portid)
+        for portids in self._exports.values():
+            portids.sort()
+
+    def ports_exporting(self, nqn):
+        '''
+        @return: The sorted list of Port IDs exporting the Subsystem I{nqn}.
+        '''
+        return list(self._exports.get(nqn, []))
+
+    def allows_any_host(self, nqn):
+        '''
+        @return: True if the Subsystem I{nqn} has allow_any_host set.
+        '''
+        return nqn in self._any_host
+
+    def subsystems_for_host(self, nqn):
+        '''
+        @return: The sorted list of Subsystem NQNs the Host I{nqn} may
+            access, either explicitly or through allow_any_host.
+        '''
+        return sorted(self._allowed.get(nqn, set()) | self._any_host)
+
+    def host_access(self, nqn):
+        '''
+        @return: A list of (subsystem nqn, portids) tuples for every
+            Subsystem the Host I{nqn} may access, with the Ports it is
+            exported through.  Subsystems without Ports are not reachable
+            and have an empty list.
+        '''
+        return [(s, self.ports_exporting(s))
+                for s in self.subsystems_for_host(nqn)]
+
+
 class Subsystem(CFSNode):
     '''
     This is an interface to a NVMe Subsystem in configFS.
@@ -435,12 +1644,17 @@ class Subsystem(CFSNode):
         self.attr_groups = ['attr']
         self._path = "%s/subsystems/%s" % (self.configfs_dir, nqn)
         self._create_in_cfs(mode)
+        self.capabilities.probe_subsystem(self._path)
+
+    def _lock_key(self):
+        return ('subsystem', self.nqn)
 
     def _generate_nqn(self):
         prefix = "nqn.2014-08.org.nvmexpress:NVMf:uuid"
         name = str(uuid.uuid4())
         return "%s:%s" % (prefix, name)
 
+    @_locked
     def delete(self):
         '''
         Recursively deletes a Subsystem object.
@@ -448,6 +1662,9 @@ class Subsystem(CFSNode):
         Subsystem itself.
         '''
         self._check_self()
+        passthru = self.passthru
+        if passthru is not None and passthru.get_enable():
+            passthru.set_enable(0)
         for ns in self.namespaces:
             ns.delete()
         for h in self.allowed_hosts:
@@ -462,6 +1679,16 @@ class Subsystem(CFSNode):
     namespaces = property(_list_namespaces,
                           doc="Get the list of Namespaces for the Subsystem.")
 
+    def _get_passthru(self):
+        self._check_self()
+        if not self.capabilities.passthru:
+            return None
+        return Passthru(self)
+
+    passthru = property(_get_passthru,
+                        doc="Get the Passthru object of the Subsystem, or "
+                            "None if the kernel does not support passthru.")
+
     def _list_allowed_hosts(self):
         return [os.path.basename(name)
                 for name in os.listdir("%s/allowed_hosts/" % self._path)]
@@ -469,31 +1696,58 @@ class Subsystem(CFSNode):
     allowed_hosts = property(_list_allowed_hosts,
                              doc="Get the list of Allowed Hosts for the Subsystem.")
 
+    @_locked
     def add_allowed_host(self, nqn):
         '''
         Enable access for the host identified by I{nqn} to the Subsystem
         '''
+        start = time.time()
         try:
             os.symlink("%s/hosts/%s" % (self.configfs_dir, nqn),
                        "%s/allowed_hosts/%s" % (self._path, nqn))
         except Exception as e:
             raise CFSError("Could not symlink %s in configFS: %s" % (nqn, e))
+        self._record('symlink', start)
 
+    @_locked
     def remove_allowed_host(self, nqn):
         '''
         Disable access for the host identified by I{nqn} to the Subsystem
         '''
+        start = time.time()
         try:
             os.unlink("%s/allowed_hosts/%s" % (self._path, nqn))
         except Exception as e:
             raise CFSError("Could not unlink %s in configFS: %s" % (nqn, e))
+        self._record('unlink', start)
+
+    @_locked
+    def set_allowed_hosts(self, nqns):
+        '''
+        Make the list of Allowed Hosts match I{nqns}, only adding and
+        removing the hosts that differ.  All hosts must already exist.
+        @return: A tuple with the lists of added and removed host NQNs.
+        '''
+        self._check_self()
+        current = set(self.allowed_hosts)
+        desired = set(nqns)
+
+        removed = sorted(current - desired)
+        for nqn in removed:
+            self.remove_allowed_host(nqn)
+        added = sorted(desired - current)
+        for nqn in added:
+            self.add_allowed_host(nqn)
+        return added, removed
 
     @classmethod
-    def setup(cls, t, err_func):
+    def setup(cls, t, err_func, journal=None):
         '''
         Set up Subsystem objects based upon t dict, from saved config.
         Guard against missing or bad dict items, but keep going.
         Call 'err_func' for each error.
+        The completed Namespaces are recorded in the RestoreJournal
+        'journal', if given, and the ones it has are skipped.
         '''
 
         if 'nqn' not in t:
@@ -506,21 +1760,125 @@ class Subsystem(CFSNode):
             err_func("Could not create Subsystem object: %s" % e)
             return
 
-        for ns in t.get('namespaces', []):
-            Namespace.setup(s, ns, err_func)
+        for ns in sorted(t.get('namespaces', []),
+                         key=lambda n: n.get('priority', 0), reverse=True):
+            _journaled(journal, "subsystems/%s/namespaces/%s" %
+                       (t['nqn'], ns.get('nsid')), err_func,
+                       Namespace.setup, s, ns)
+        # The Subsystem may be left over from an interrupted restore
+        allowed_hosts = s.allowed_hosts
         for h in t.get('allowed_hosts', []):
-            s.add_allowed_host(h)
+            if h not in allowed_hosts:
+                s.add_allowed_host(h)
 
         s._setup_attrs(t, err_func)
 
+        if 'passthru' in t:
+            Passthru.setup(s, t['passthru'], err_func)
+
+    def info(self, fields=None):
+        d = super(Subsystem, self).info(fields)
+        d['nqn'] = self.nqn
+        if _wanted(fields, 'allowed_hosts'):
+            d['allowed_hosts'] = sorted(self.allowed_hosts)
+        if _wanted(fields, 'passthru'):
+            passthru_fields = None
+        else:
+            passthru_fields = [f for f in fields
+                               if f.startswith('passthru.')]
+        if passthru_fields != []:
+            passthru = self.passthru
+            if passthru is not None and \
+                    passthru.get_attr('passthru', 'device_path'):
+                d['passthru'] = passthru.info(passthru_fields)
+        return d
+
     def dump(self):
         d = super(Subsystem, self).dump()
         d['nqn'] = self.nqn
         d['namespaces'] = [ns.dump() for ns in self.namespaces]
         d['allowed_hosts'] = self.allowed_hosts
+        passthru = self.passthru
+        if passthru is not None and passthru.get_attr('passthru',
+                                                      'device_path'):
+            d['passthru'] = passthru.dump()
         return d
 
 
+class Passthru(CFSNode):
+    '''
+    This is an interface to the passthru directory of a Subsystem, which
+    exports a whole NVMe controller instead of Namespaces.  Its attributes
+    (device_path, admin_timeout, io_timeout, clear_ids) are in the single
+    group 'passthru'.  The kernel creates it with the Subsystem.
+    '''
+
+    def __repr__(self):
+        return "<Passthru %s>" % self._subsystem.nqn
+
+    def __init__(self, subsystem):
+        '''
+        @param subsystem: The parent Subsystem object.
+        @return: A Passthru object.
+        '''
+        super(Passthru, self).__init__()
+
+        self.attr_groups = ['passthru']
+        self._subsystem = subsystem
+        self._path = "%s/passthru" % subsystem.path
+        if not self.exists:
+            raise CFSNotFound("Passthru not supported by %s" % subsystem.nqn)
+        self.get_enable()
+
+    def _attr_path(self, group, attribute):
+        return "%s/%s" % (self.path, str(attribute))
+
+    def _lock_key(self):
+        return self._subsystem._lock_key()
+
+    subsystem = property(lambda self: self._subsystem,
+                         doc="Get the parent Subsystem object.")
+
+    @classmethod
+    def setup(cls, subsys, t, err_func):
+        '''
+        Set up the Passthru of Subsystem subsys based upon t dict, from
+        saved config.  Guard against missing or bad dict items, but keep
+        going.  Call 'err_func' for each error.
+        '''
+        passthru = subsys.passthru
+        if passthru is None:
+            err_func("Passthru not supported, not setting up %s" %
+                     subsys.nqn)
+            return
+
+        # The Subsystem may be left over from an interrupted restore
+        if passthru._enable:
+            passthru.set_enable(0)
+        passthru._setup_attrs({'passthru': dict(
+            (k, v) for k, v in iteritems(t) if k != 'enable'),
+            'enable': t.get('enable')}, err_func)
+
+    def info(self, fields=None):
+        '''
+        Like dump(), see CFSNode.info().  Fields are given as
+        'passthru.<attribute>', including 'passthru.enable'.
+        '''
+        if fields is not None and 'passthru.enable' in fields:
+            fields = fields + ['enable']
+        d = super(Passthru, self).info(fields)
+        p = d.pop('passthru', {})
+        if 'enable' in d:
+            p['enable'] = d['enable']
+        return p
+
+    def dump(self):
+        d = super(Passthru, self).dump()
+        p = d.pop('passthru')
+        p['enable'] = d['enable']
+        return p
+
+
 class Namespace(CFSNode):
     '''
     This is an interface to a NVMe Namespace in configFS.
@@ -579,6 +1937,9 @@ class Namespace(CFSNode):
     def _get_nsid(self):
         return self._nsid
 
+    def _lock_key(self):
+        return self._subsystem._lock_key()
+
     def _get_grpid(self):
         self._check_self()
         _grpid = 0
@@ -592,11 +1953,132 @@ class Namespace(CFSNode):
         self._check_self()
         path = "%s/ana_grpid" % self.path
         if os.path.isfile(path):
+            start = time.time()
             with open(path, 'w') as file_fd:
                 file_fd.write(str(grpid))
+            self._record('write', start)
 
     grpid = property(_get_grpid, doc="Get the ANA Group ID.")
 
+    def revalidate_size(self):
+        '''
+        Make the kernel read the size of the backing device again, e.g.
+        after it has been grown.  The Namespace must be enabled.
+        @return: The size of the backing device in bytes.
+        '''
+        self._check_self()
+        path = "%s/revalidate_size" % self.path
+        if not os.path.isfile(path):
+            raise CFSError("Revalidating the size is not supported")
+        if not self.get_enable():
+            raise CFSError("Cannot revalidate the size of %s while it is "
+                           "disabled" % self.path)
+
+        start = time.time()
+        try:
+            with open(path, 'w') as file_fd:
+                file_fd.write("1")
+        except (IOError, OSError) as e:
+            raise CFSError("Cannot revalidate the size of %s: %s" %
+                           (self.path, e))
+        self._record('write', start)
+        return _device_size(self.get_attr('device', 'path'))
+
+    def _check_changes(self, changes):
+        '''
+        Check the attributes and ANA Group ID reconfigure() is asked to
+        set, raising a CFSError for the first invalid one.
+        '''
+        for group, values in iteritems(changes):
+            if not isinstance(values, dict):
+                continue
+            if group not in self.attr_groups:
+                raise CFSError("Invalid attribute group: %s" % group)
+            writable = self.list_attrs(group, writable=True)
+            for name, value in iteritems(values):
+                if name not in writable:
+                    raise CFSError("Cannot set attribute: %s_%s" %
+                                   (group, name))
+                if group == 'device' and name == 'path' and \
+                        not os.path.exists(str(value)):
+                    raise CFSError("No such device: %s" % value)
+                if group == 'device' and name in ('uuid', 'nguid'):
+                    try:
+                        uuid.UUID(str(value))
+                    except ValueError:
+                        raise CFSError("Invalid %s: %s" % (name, value))
+
+        grpid = changes.get('ana_grpid')
+        if grpid is not None:
+            grpid = int(grpid)
+            if not self.capabilities.ana:
+                raise CFSError("ANA not supported")
+            if grpid < 1 or grpid > ANAGroup.MAX_GRPID or \
+                    not any(glob("%s/ports/*/ana_groups/%d" %
+                                 (self.configfs_dir, grpid))):
+                raise CFSError("No such ANA Group: %d" % grpid)
+
+    def _write_attrs(self, changes):
+        for group, values in iteritems(changes):
+            if isinstance(values, dict):
+                for name, value in iteritems(values):
+                    self.set_attr(group, name, value)
+
+    @_locked
+    def reconfigure(self, changes):
+        '''
+        Change attributes of the Namespace, even while it is enabled.  All
+        values are checked first.  If device attributes change on an
+        enabled Namespace, it is disabled, all of them are written and it
+        is enabled again in one go.  If that fails, the previous values
+        are written back and the Namespace is enabled again before the
+        error is raised.  The ANA Group is changed without disabling it.
+        @param changes: A dict in the format of a saved Namespace, e.g.
+            {'device': {'path': '/dev/nvme0n1'}, 'ana_grpid': 2}.
+        @return: The number of seconds the Namespace was disabled.
+        '''
+        self._check_self()
+        self._check_changes(changes)
+
+        old = {}
+        for group, values in iteritems(changes):
+            if isinstance(values, dict):
+                old[group] = dict((name, self.get_attr(group, name))
+                                  for name in values)
+        changed = any(str(value) != old[group][name]
+                      for group in old
+                      for name, value in iteritems(changes[group]))
+
+        window = 0.0
+        if changed:
+            enabled = self.get_enable()
+            start = time.time()
+            try:
+                if enabled:
+                    self.set_enable(0)
+                self._write_attrs(changes)
+                if enabled:
+                    self.set_enable(1)
+            except CFSError as e:
+                try:
+                    if self._enable:
+                        self.set_enable(0)
+                    self._write_attrs(old)
+                    if enabled:
+                        self.set_enable(1)
+                except CFSError as e2:
+                    raise CFSError("Could not reconfigure %s: %s, restoring "
+                                   "it failed too: %s" % (self.path, e, e2))
+                raise CFSError("Could not reconfigure %s, left unchanged: %s"
+                               % (self.path, e))
+            if enabled:
+                window = time.time() - start
+
+        grpid = changes.get('ana_grpid')
+        if grpid is not None and int(grpid) != self.grpid:
+            self.set_grpid(int(grpid))
+        return window
+
     subsystem = property(_get_subsystem,
                          doc="Get the parent Subsystem object.")
     nsid = property(_get_nsid, doc="Get the NSID as an int.")
@@ -619,10 +2101,20 @@ class Namespace(CFSNode):
             err_func("Could not create Namespace object: %s" % e)
             return
 
+        # Left enabled by an interrupted restore, attributes can't be set
+        if ns._enable:
+            ns.set_enable(0)
         ns._setup_attrs(n, err_func)
         if 'ana_grpid' in n:
             ns.set_grpid(int(n['ana_grpid']))
 
+    def info(self, fields=None):
+        d = super(Namespace, self).info(fields)
+        d['nsid'] = self.nsid
+        if _wanted(fields, 'ana_grpid'):
+            d['ana_grpid'] = self.grpid
+        return d
+
     def dump(self):
         d = super(Namespace, self).dump()
         d['nsid'] = self.nsid
@@ -647,12 +2139,16 @@ class Port(CFSNode):
         self._portid = int(portid)
         self._path = "%s/ports/%d" % (self.configfs_dir, self._portid)
         self._create_in_cfs(mode)
+        self.capabilities.probe_port(self._path)
 
     def _get_portid(self):
         return self._portid
 
     portid = property(_get_portid, doc="Get the Port ID as an int.")
 
+    def _lock_key(self):
+        return ('port', self._portid)
+
     def _list_subsystems(self):
         return [os.path.basename(name)
                 for name in os.listdir("%s/subsystems/" % self._path)]
@@ -660,25 +2156,32 @@ class Port(CFSNode):
     subsystems = property(_list_subsystems,
                           doc="Get the list of Subsystem for this Port.")
 
+    @_locked
     def add_subsystem(self, nqn):
         '''
         Enable access to the Subsystem identified by I{nqn} through this Port.
         '''
+        start = time.time()
         try:
             os.symlink("%s/subsystems/%s" % (self.configfs_dir, nqn),
                        "%s/subsystems/%s" % (self._path, nqn))
         except Exception as e:
             raise CFSError("Could not symlink %s in configFS: %s" % (nqn, e))
+        self._record('symlink', start)
 
+    @_locked
     def remove_subsystem(self, nqn):
         '''
         Disable access to the Subsystem identified by I{nqn} through this Port.
         '''
+        start = time.time()
         try:
             os.unlink("%s/subsystems/%s" % (self._path, nqn))
         except Exception as e:
             raise CFSError("Could not unlink %s in configFS: %s" % (nqn, e))
+        self._record('unlink', start)
 
+    @_locked
     def delete(self):
         '''
         Recursively deletes a Port object.
@@ -702,19 +2205,90 @@ class Port(CFSNode):
 
     def _list_ana_groups(self):
         self._check_self()
-        if os.path.isdir("%s/ana_groups/" % self._path):
+        if self.capabilities.ana:
             for d in os.listdir("%s/ana_groups/" % self._path):
                 yield ANAGroup(self, int(d), 'lookup')
 
     ana_groups = property(_list_ana_groups,
                           doc="Get the list of ANA Groups for this Port.")
 
+    def check_profile(self, profile):
+        '''
+        Check that a port profile (see validate_config()) is meant for the
+        transport type of the Port, and that the kernel supports all of
+        its attributes.  Raises a CFSError for the first problem found.
+        '''
+        self._check_self()
+        trtype = self.get_attr('addr', 'trtype')
+        if profile.get('trtype') != trtype:
+            raise CFSError("Profile %s is for trtype %s, port %d is %s" %
+                           (profile.get('name'), profile.get('trtype'),
+                            self.portid, trtype))
+        for group in _groups(profile):
+            writable = self.list_attrs(group, writable=True)
+            for name in profile[group]:
+                if name not in writable:
+                    raise CFSError("%s_%s of profile %s not supported by "
+                                   "the kernel" %
+                                   (group, name, profile.get('name')))
+
+    @_locked
+    def apply_profile(self, profile):
+        '''
+        Set the attributes of a port profile on the Port, see
+        check_profile().  Only attributes that differ are written.  The
+        kernel refuses changes while the Port is linked to Subsystems, so
+        the links are removed around the writes and then restored.  If a
+        write fails, the previous values are written back before the error
+        is raised.
+        @param profile: A port profile dict, e.g. {'name': 'tcp-fast',
+            'version': 1, 'trtype': 'tcp',
+            'param': {'inline_data_size': '16384'}}.
+        @return: The number of seconds the Port was not linked to its
+            Subsystems.
+        '''
+        self.check_profile(profile)
+        writes = []
+        for group in _groups(profile):
+            for name, value in sorted(iteritems(profile[group])):
+                old = self.get_attr(group, name)
+                if old != str(value):
+                    writes.append((group, name, value, old))
+        if not writes:
+            return 0.0
+
+        links = self.subsystems
+        start = time.time()
+        try:
+            for nqn in links:
+                self.remove_subsystem(nqn)
+            for group, name, value, old in writes:
+                self.set_attr(group, name, value)
+        except CFSError as e:
+            for group, name, value, old in writes:
+                try:
+                    self.set_attr(group, name, old)
+                except CFSError:
+                    pass
+            raise CFSError("Could not apply profile %s to port %d, left "
+                           "unchanged: %s" % (profile.get('name'),
+                                              self.portid, e))
+        finally:
+            current = self.subsystems
+            for nqn in links:
+                if nqn not in current:
+                    self.add_subsystem(nqn)
+        if not links:
+            return 0.0
+        return time.time() - start
+
     @classmethod
-    def setup(cls, root, n, err_func):
+    def setup(cls, root, n, err_func, link=True):
         '''
         Set up a Port object based upon n dict, from saved config.
         Guard against missing or bad dict items, but keep going.
         Call 'err_func' for each error.
+        The Port is only linked to its Subsystems if 'link' is True.
         '''
 
         if 'portid' not in n:
@@ -728,13 +2302,20 @@ class Port(CFSNode):
             return
 
         port._setup_attrs(n, err_func)
-        for s in n.get('subsystems', []):
+        for s in n.get('subsystems', []) if link else []:
             port.add_subsystem(s)
         for a in n.get('ana_groups', []):
             ANAGroup.setup(port, a, err_func)
         for r in n.get('referrals', []):
             Referral.setup(port, r, err_func)
 
+    def info(self, fields=None):
+        d = super(Port, self).info(fields)
+        d['portid'] = self.portid
+        if _wanted(fields, 'subsystems'):
+            d['subsystems'] = sorted(self.subsystems)
+        return d
+
     def dump(self):
         d = super(Port, self).dump()
         d['portid'] = self.portid
@@ -769,6 +2350,9 @@ class Referral(CFSNode):
 
     name = property(_get_name, doc="Get the Referral name.")
 
+    def _lock_key(self):
+        return self.port._lock_key()
+
     @classmethod
     def setup(cls, port, n, err_func):
         '''
@@ -789,6 +2373,11 @@ class Referral(CFSNode):
 
         r._setup_attrs(n, err_func)
 
+    def info(self, fields=None):
+        d = super(Referral, self).info(fields)
+        d['name'] = self.name
+        return d
+
     def dump(self):
         d = super(Referral, self).dump()
         d['name'] = self.name
@@ -808,7 +2397,7 @@ class ANAGroup(CFSNode):
     def __init__(self, port, grpid, mode='any'):
         super(ANAGroup, self).__init__()
 
-        if not os.path.isdir("%s/ana_groups" % port.path):
+        if not port.capabilities.ana:
             raise CFSError("ANA not supported")
 
         if grpid is None:
@@ -838,6 +2427,9 @@ class ANAGroup(CFSNode):
 
     grpid = property(_get_grpid, doc="Get the ANA Group ID.")
 
+    def _lock_key(self):
+        return self._port._lock_key()
+
     @classmethod
     def setup(cls, port, n, err_func):
         '''
@@ -863,6 +2455,11 @@ class ANAGroup(CFSNode):
         if self.grpid != 1:
             super(ANAGroup, self).delete()
 
+    def info(self, fields=None):
+        d = super(ANAGroup, self).info(fields)
+        d['grpid'] = self.grpid
+        return d
+
     def dump(self):
         d = super(ANAGroup, self).dump()
         d['grpid'] = self.grpid
@@ -892,10 +2489,14 @@ class Host(CFSNode):
         '''
         super(Host, self).__init__()
 
+        self.attr_groups = ['dhchap']
         self.nqn = nqn
         self._path = "%s/hosts/%s" % (self.configfs_dir, nqn)
         self._create_in_cfs(mode)
 
+    def _lock_key(self):
+        return ('host', self.nqn)
+
     @classmethod
     def setup(cls, t, err_func):
         '''
@@ -914,12 +2515,79 @@ class Host(CFSNode):
             err_func("Could not create Host object: %s" % e)
             return
 
+        h._setup_attrs(t, err_func)
+
+    @_locked
+    def set_keys(self, keys):
+        '''
+        Set the DH-HMAC-CHAP attributes of the Host.  All values are
+        checked first, and if one can't be written, the previous values
+        are written back before the error is raised.
+        @param keys: A dict of dhchap attributes, e.g.
+            {'key': 'DHHC-1:00:...:', 'ctrl_key': 'DHHC-1:00:...:'}.
+        '''
+        self._check_self()
+        writable = self.list_attrs('dhchap', writable=True)
+        for name, value in iteritems(keys):
+            if name not in writable:
+                raise CFSError("Cannot set attribute: dhchap_%s" % name)
+            if name in ('key', 'ctrl_key') and \
+                    not _DHCHAP_KEY.match(str(value)):
+                raise CFSError("Invalid DH-HMAC-CHAP %s for %s" %
+                               (name, self.nqn))
+
+        old = dict((name, self.get_attr('dhchap', name)) for name in keys)
+        try:
+            # The keys last, so that most failures leave no key behind
+            for name, value in sorted(iteritems(keys), key=lambda kv:
+                                      (kv[0] in ('key', 'ctrl_key'), kv[0])):
+                self.set_attr('dhchap', name, value)
+        except CFSError:
+            # Empty values are written back too, clearing new keys
+            for name, value in iteritems(old):
+                try:
+                    self.set_attr('dhchap', name, value)
+                except CFSError:
+                    pass
+            raise
+
+    def info(self, fields=None):
+        d = super(Host, self).info(fields)
+        d['nqn'] = self.nqn
+        return d
+
     def dump(self):
         d = super(Host, self).dump()
+        # Unset keys read back empty, and can't be written that way.  The
+        # hash and group only matter, and are only saved, with a key.
+        dhchap = dict((k, v) for k, v in iteritems(d.pop('dhchap', {})) if v)
+        if dhchap.get('key') or dhchap.get('ctrl_key'):
+            d['dhchap'] = dhchap
         d['nqn'] = self.nqn
         return d
 
 
+_TOP_COLLECTIONS = ['subsystems', 'ports', 'hosts']
+
+# collection: (type, lookup(parent, name), numeric names, child collections)
+_COLLECTIONS = {
+    'subsystems': ('subsystem', lambda parent, name: Subsystem(name, 'lookup'),
+                   False, ['namespaces']),
+    'namespaces': ('namespace',
+                   lambda parent, name: Namespace(parent, name, 'lookup'),
+                   True, []),
+    'ports': ('port', lambda parent, name: Port(name, 'lookup'),
+              True, ['ana_groups', 'referrals']),
+    'ana_groups': ('ana_group',
+                   lambda parent, name: ANAGroup(parent, name, 'lookup'),
+                   True, []),
+    'referrals': ('referral',
+                  lambda parent, name: Referral(parent, name, 'lookup'),
+                  False, []),
+    'hosts': ('host', lambda parent, name: Host(name, 'lookup'), False, []),
+}
+
+
 def _test():
     from doctest import testmod
     testmod()
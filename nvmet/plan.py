@@ -0,0 +1,472 @@
+'''
+Turns saved NVMe target configurations into explicit configfs operations
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+License for the specific language governing permissions and limitations
+under the License.
+'''
+
+import copy
+import json
+import os
+from six import iteritems
+
+DEFAULT_STATS_FILE = '/etc/nvmet/latency.json'
+
+OPS = ['unlink', 'rmdir', 'mkdir', 'write', 'enable', 'symlink']
+
+# Disabling an object takes far less time than enabling it, so enable
+# operations writing 0 are timed apart
+STATS_OPS = OPS + ['disable']
+
+
+def stats_op(op, value):
+    '''
+    @return: The OpStats key of the operation I{op} writing I{value}.
+    '''
+    if op == 'enable' and not int(value):
+        return 'disable'
+    return op
+
+
+class OpStats(object):
+    '''
+    Running latency statistics per configfs operation type, used to
+    estimate how long a RestorePlan takes.  While a Root.restore() is
+    given an OpStats object, every configfs operation is recorded in it.
+    '''
+
+    # Rough guesses, used until real latencies have been recorded
+    DEFAULT_LATENCY = {
+        'unlink': 0.001,
+        'rmdir': 0.002,
+        'mkdir': 0.002,
+        'write': 0.0002,
+        'enable': 0.02,
+        'disable': 0.002,
+        'symlink': 0.001,
+    }
+
+    def __init__(self):
+        self.count = {}
+        self.total = {}
+
+    def record(self, op, node, seconds):
+        '''
+        Record that operation I{op} on the CFSNode I{node} took I{seconds}.
+        Only the operations in STATS_OPS are kept, as only those are
+        planned.
+        '''
+        if op not in STATS_OPS:
+            return
+        self.count[op] = self.count.get(op, 0) + 1
+        self.total[op] = self.total.get(op, 0.0) + seconds
+
+    def latency(self, op):
+        '''
+        @return: The mean recorded latency of I{op} in seconds, or the
+            default guess if it has never been recorded.
+        '''
+        if self.count.get(op):
+            return self.total[op] / self.count[op]
+        return self.DEFAULT_LATENCY.get(op, 0.0)
+
+    @classmethod
+    def load(cls, statsfile=None):
+        '''
+        Read statistics saved by save(), starting empty if there are none.
+        '''
+        stats = cls()
+        try:
+            with open(statsfile or DEFAULT_STATS_FILE, "r") as f:
+                d = json.loads(f.read())
+        except (IOError, ValueError):
+            return stats
+        for op, (count, total) in iteritems(d):
+            stats.count[op] = count
+            stats.total[op] = total
+        return stats
+
+    def save(self, statsfile=None):
+        statsfile = statsfile or DEFAULT_STATS_FILE
+        d = dict((op, [self.count[op], self.total[op]]) for op in self.count)
+        with open(statsfile + ".temp", "w") as f:
+            f.write(json.dumps(d, sort_keys=True, indent=2))
+            f.write("\n")
+        os.rename(statsfile + ".temp", statsfile)
+
+
+def _groups(obj):
+    return [k for k, v in iteritems(obj) if isinstance(v, dict)]
+
+
+def _index(objs, key):
+    return dict((o[key], o) for o in objs if key in o)
+
+
+def _address(port):
+    addr = port.get('addr', {})
+    return tuple(str(addr.get(name, ''))
+                 for name in ('trtype', 'adrfam', 'traddr', 'trsvcid'))
+
+
+def referral_mesh(ports, peers, trtype=None, prune=True):
+    '''
+    Compute the discovery referrals that make every Port refer to all other
+    Ports of the cluster with the same transport type and address family,
+    so that a host finds all paths with a single discovery.  Ports without
+    a transport address, like loop Ports, are left out.
+    @param ports: The local Ports, as in the 'ports' list of Root.dump().
+    @param peers: The Ports of the other cluster nodes in the same format,
+        only their portid and addr are used.  Ports with the address of a
+        local Port are ignored, so the same list of all Ports of the
+        cluster can be used on every node.
+    @param trtype: Only change the referrals of Ports of this transport
+        type.
+    @param prune: If True, the referrals of the changed Ports that are not
+        part of the mesh are removed, otherwise they are kept.
+    @return: A copy of ports with the referrals replaced.  Existing
+        referrals to a Port keep their name.
+    '''
+    local = set(_address(p) for p in ports)
+    cluster = list(ports) + [p for p in peers if _address(p) not in local]
+
+    meshed = []
+    for p in ports:
+        p = copy.deepcopy(p)
+        meshed.append(p)
+        addr = _address(p)
+        if not addr[2] or (trtype is not None and addr[0] != trtype):
+            continue
+
+        old = dict((_address(r), r) for r in p.get('referrals', []))
+        names = set(r['name'] for r in p.get('referrals', []))
+        referrals = []
+        seen = set([addr])
+        for q in cluster:
+            target = _address(q)
+            if target in seen or not target[2] or target[:2] != addr[:2]:
+                continue
+            seen.add(target)
+            r = old.pop(target, None)
+            if r is not None:
+                name = r['name']
+            else:
+                base = "-".join(a for a in target if a).replace('/', '_')
+                name = base
+                index = 1
+                while name in names:
+                    index += 1
+                    name = "%s-%d" % (base, index)
+                names.add(name)
+            r = {'name': name, 'addr': {}, 'enable': 1}
+            for key in ('trtype', 'adrfam', 'traddr', 'trsvcid', 'treq'):
+                if key in q['addr']:
+                    r['addr'][key] = q['addr'][key]
+            if 'portid' in q:
+                r['addr']['portid'] = str(q['portid'])
+            referrals.append(r)
+        if not prune:
+            referrals.extend(r for r in p.get('referrals', [])
+                             if _address(r) in old)
+        p['referrals'] = referrals
+    return meshed
+
+
+def _priority(t):
+    '''
+    The priority of a Subsystem dict from a saved config, which is the
+    highest 'priority' of the Subsystem and its Namespaces.  Priorities
+    are integers, higher ones are restored first, the default is 0.
+    '''
+    return max([t.get('priority', 0)] +
+               [n.get('priority', 0) for n in t.get('namespaces', [])])
+
+
+class RestorePlan(object):
+    '''
+    An ordered list of configfs operations that turns the live configuration
+    into a saved one.  Each operation is an (op, path, value) tuple, where
+    op is one of OPS and path is relative to the configfs root:
+      - mkdir, rmdir: path is the object directory, value is None
+      - write: path is the attribute file, value the string written to it
+      - enable: path is the enable file, value the enable state
+      - symlink, unlink: path is the link, value the link target
+    Like Root.restore(), the plan builds the Hosts, then the Ports, and
+    then the Subsystems in order of priority, each followed by the links
+    that export it.
+    '''
+
+    def __init__(self, config, live=None, clear_existing=False):
+        '''
+        @param config: A dict generated by Root.dump() to restore.
+        @param live: A dict generated by Root.dump() of the live
+            configuration, or None if configfs is empty.
+        @param clear_existing: If True, everything in I{live} is removed
+            and I{config} rebuilt from scratch, as Root.restore() does.
+            Otherwise only the differences between I{live} and I{config}
+            are planned.
+        '''
+        # Links and directories are removed before anything is created
+        self._teardown = []
+        self._build = []
+        # Port links by Subsystem NQN, added after the Subsystem
+        self._links = {}
+        if live is None:
+            live = {}
+        elif clear_existing:
+            self._clear(live)
+            live = {}
+
+        old_hosts = _index(live.get('hosts', []), 'nqn')
+        old_subsystems = _index(live.get('subsystems', []), 'nqn')
+        old_ports = _index(live.get('ports', []), 'portid')
+        new_hosts = _index(config.get('hosts', []), 'nqn')
+        new_subsystems = _index(config.get('subsystems', []), 'nqn')
+        new_ports = _index(config.get('ports', []), 'portid')
+
+        for t in config.get('hosts', []):
+            if 'nqn' not in t:
+                continue
+            if t['nqn'] not in old_hosts:
+                self._add('mkdir', "hosts/%s" % t['nqn'])
+            self._attrs("hosts/%s" % t['nqn'], old_hosts.get(t['nqn']), t)
+        for t in config.get('ports', []):
+            if 'portid' in t:
+                self._port(old_ports.get(t['portid']), t)
+        subsystems = [t for t in config.get('subsystems', []) if 'nqn' in t]
+        for t in sorted(subsystems, key=_priority, reverse=True):
+            self._subsystem(old_subsystems.get(t['nqn']), t)
+            self._build.extend(self._links.pop(t['nqn'], []))
+        # Links to Subsystems that are not in the config
+        for nqn, links in sorted(iteritems(self._links)):
+            self._build.extend(links)
+
+        for portid, p in iteritems(old_ports):
+            if portid not in new_ports:
+                self._clear_port(p)
+        for nqn, s in iteritems(old_subsystems):
+            if nqn not in new_subsystems:
+                self._clear_subsystem(s)
+        for nqn in old_hosts:
+            if nqn not in new_hosts:
+                self._teardown.append(('rmdir', "hosts/%s" % nqn, None))
+
+        self.ops = self._teardown + self._build
+        del self._teardown, self._build, self._links
+
+    def __iter__(self):
+        return iter(self.ops)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def _add(self, op, path, value=None):
+        self._build.append((op, path, value))
+
+    def _clear(self, live):
+        for p in live.get('ports', []):
+            self._clear_port(p)
+        for s in live.get('subsystems', []):
+            self._clear_subsystem(s)
+        for h in live.get('hosts', []):
+            self._teardown.append(('rmdir', "hosts/%s" % h['nqn'], None))
+
+    def _clear_port(self, p):
+        path = "ports/%d" % p['portid']
+        for nqn in p.get('subsystems', []):
+            self._teardown.append(('unlink', "%s/subsystems/%s" % (path, nqn),
+                                   "subsystems/%s" % nqn))
+        for a in p.get('ana_groups', []):
+            if a['grpid'] != 1:
+                self._teardown.append(
+                    ('rmdir', "%s/ana_groups/%d" % (path, a['grpid']), None))
+        for r in p.get('referrals', []):
+            self._teardown.append(
+                ('rmdir', "%s/referrals/%s" % (path, r['name']), None))
+        self._teardown.append(('rmdir', path, None))
+
+    def _clear_subsystem(self, s):
+        path = "subsystems/%s" % s['nqn']
+        if s.get('passthru', {}).get('enable'):
+            self._teardown.append(('enable', "%s/passthru/enable" % path, 0))
+        for ns in s.get('namespaces', []):
+            self._teardown.append(
+                ('rmdir', "%s/namespaces/%d" % (path, ns['nsid']), None))
+        for nqn in s.get('allowed_hosts', []):
+            self._teardown.append(
+                ('unlink', "%s/allowed_hosts/%s" % (path, nqn),
+                 "hosts/%s" % nqn))
+        self._teardown.append(('rmdir', path, None))
+
+    def _attrs(self, path, old, new):
+        '''
+        Plan the attribute writes and enable of one object, disabling it
+        around the writes if it is enabled.  old is None for new objects.
+        '''
+        writes = []
+        for group in _groups(new):
+            for name, value in sorted(iteritems(new[group])):
+                if old is None or \
+                        str(old.get(group, {}).get(name)) != str(value):
+                    writes.append(("%s/%s_%s" % (path, group, name), value))
+        self._writes(path, old, new, writes)
+
+    def _writes(self, path, old, new, writes):
+        enable = new.get('enable')
+        was_enabled = old is not None and old.get('enable')
+        if writes and was_enabled:
+            self._add('enable', "%s/enable" % path, 0)
+            was_enabled = 0
+        for attr, value in writes:
+            self._add('write', attr, value)
+        if enable is not None and (old is None or enable != was_enabled):
+            self._add('enable', "%s/enable" % path, enable)
+
+    def _passthru(self, path, old, new):
+        '''
+        Plan the passthru directory of a Subsystem, whose attributes have
+        no group prefix.  old and new are None if there is no passthru.
+        '''
+        path = "%s/passthru" % path
+        if new is None:
+            if old and old.get('enable'):
+                self._add('enable', "%s/enable" % path, 0)
+            return
+        writes = []
+        for name, value in sorted(iteritems(new)):
+            if name != 'enable' and \
+                    (old is None or str(old.get(name)) != str(value)):
+                writes.append(("%s/%s" % (path, name), value))
+        self._writes(path, old, new, writes)
+
+    def _subsystem(self, old, new):
+        path = "subsystems/%s" % new['nqn']
+        if old is None:
+            self._add('mkdir', path)
+            old = {}
+
+        old_ns = _index(old.get('namespaces', []), 'nsid')
+        new_ns = _index(new.get('namespaces', []), 'nsid')
+        for nsid, ns in iteritems(old_ns):
+            if nsid not in new_ns:
+                self._teardown.append(
+                    ('rmdir', "%s/namespaces/%d" % (path, nsid), None))
+        for ns in new.get('namespaces', []):
+            if 'nsid' not in ns:
+                continue
+            ns_path = "%s/namespaces/%d" % (path, ns['nsid'])
+            if ns['nsid'] not in old_ns:
+                self._add('mkdir', ns_path)
+            self._attrs(ns_path, old_ns.get(ns['nsid']), ns)
+            if 'ana_grpid' in ns and 'grpid' not in ns.get('ana', {}) and \
+                    old_ns.get(ns['nsid'], {}).get('ana_grpid') != \
+                    ns['ana_grpid']:
+                self._add('write', "%s/ana_grpid" % ns_path, ns['ana_grpid'])
+
+        old_hosts = set(old.get('allowed_hosts', []))
+        new_hosts = new.get('allowed_hosts', [])
+        for nqn in sorted(old_hosts - set(new_hosts)):
+            self._teardown.append(
+                ('unlink', "%s/allowed_hosts/%s" % (path, nqn),
+                 "hosts/%s" % nqn))
+        for nqn in new_hosts:
+            if nqn not in old_hosts:
+                self._add('symlink', "%s/allowed_hosts/%s" % (path, nqn),
+                          "hosts/%s" % nqn)
+
+        self._attrs(path, old or None, dict(
+            (k, v) for k, v in iteritems(new)
+            if k not in ('namespaces', 'passthru')))
+        self._passthru(path, old.get('passthru'), new.get('passthru'))
+
+    def _port(self, old, new):
+        path = "ports/%d" % new['portid']
+        old_links = []
+        if old is None:
+            self._add('mkdir', path)
+        else:
+            old_links = old.get('subsystems', [])
+            # No attribute can change while the port is in use, see
+            # Port.apply_profile()
+            if old_links and any(
+                    str(old.get(group, {}).get(name)) != str(value)
+                    for group in _groups(new)
+                    for name, value in iteritems(new[group])):
+                for nqn in old_links:
+                    self._teardown.append(
+                        ('unlink', "%s/subsystems/%s" % (path, nqn),
+                         "subsystems/%s" % nqn))
+                old_links = []
+
+        self._attrs(path, old, new)
+
+        new_links = new.get('subsystems', [])
+        for nqn in old_links:
+            if nqn not in new_links:
+                self._teardown.append(
+                    ('unlink', "%s/subsystems/%s" % (path, nqn),
+                     "subsystems/%s" % nqn))
+        for nqn in new_links:
+            if nqn not in old_links:
+                self._links.setdefault(nqn, []).append(
+                    ('symlink', "%s/subsystems/%s" % (path, nqn),
+                     "subsystems/%s" % nqn))
+
+        old = old or {}
+        old_groups = _index(old.get('ana_groups', []), 'grpid')
+        new_groups = _index(new.get('ana_groups', []), 'grpid')
+        for grpid in old_groups:
+            if grpid not in new_groups and grpid != 1:
+                self._teardown.append(
+                    ('rmdir', "%s/ana_groups/%d" % (path, grpid), None))
+        for a in new.get('ana_groups', []):
+            if 'grpid' not in a:
+                continue
+            a_path = "%s/ana_groups/%d" % (path, a['grpid'])
+            # ANA Group 1 is automatically created
+            if a['grpid'] not in old_groups and a['grpid'] != 1:
+                self._add('mkdir', a_path)
+            self._attrs(a_path, old_groups.get(a['grpid']), a)
+
+        old_refs = _index(old.get('referrals', []), 'name')
+        new_refs = _index(new.get('referrals', []), 'name')
+        for name in old_refs:
+            if name not in new_refs:
+                self._teardown.append(
+                    ('rmdir', "%s/referrals/%s" % (path, name), None))
+        for r in new.get('referrals', []):
+            if 'name' not in r:
+                continue
+            r_path = "%s/referrals/%s" % (path, r['name'])
+            if r['name'] not in old_refs:
+                self._add('mkdir', r_path)
+            self._attrs(r_path, old_refs.get(r['name']), r)
+
+    def counts(self):
+        '''
+        @return: A dict with the number of operations of each type.
+        '''
+        counts = dict((op, 0) for op in OPS)
+        for op, path, value in self.ops:
+            counts[op] += 1
+        return counts
+
+    def estimate(self, stats=None):
+        '''
+        @param stats: An OpStats object with recorded latencies, the
+            default guesses are used if None.
+        @return: The estimated time in seconds to execute the plan.
+        '''
+        if stats is None:
+            stats = OpStats()
+        return sum(stats.latency(stats_op(op, value))
+                   for op, path, value in self.ops)
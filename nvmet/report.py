@@ -0,0 +1,185 @@
+'''
+Structured reports of restores, clears and saves
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+License for the specific language governing permissions and limitations
+under the License.
+
+While a Report is active, every configfs operation is recorded for the
+object it was done on, identified by its path relative to the configfs
+root, e.g. "subsystems/<nqn>/namespaces/1".  The time is summed up per
+phase:
+
+    mkdir    creating objects
+    attrs    writing attributes
+    enable   enabling and disabling objects
+    link     creating and removing symlinks
+    rmdir    removing objects
+    read     reading attributes
+'''
+
+import json
+import threading
+import time
+from six import iteritems
+
+from .nvme import CFSNode, CFSError
+
+PHASES = {
+    'mkdir': 'mkdir',
+    'write': 'attrs',
+    'enable': 'enable',
+    'disable': 'enable',
+    'symlink': 'link',
+    'unlink': 'link',
+    'rmdir': 'rmdir',
+    'read': 'read',
+}
+
+
+class Report(object):
+    '''
+    The report of one restore, clear or save, see the module documentation.
+    Pass it to Root.restore(), or use it as a with block around other
+    operations.
+    '''
+
+    def __init__(self, operation, stats=None, slowest=10):
+        '''
+        @param operation: The name of the reported operation, e.g. 'restore'.
+        @param stats: An optional OpStats object every operation is also
+            recorded in.
+        @param slowest: The number of slowest objects listed.
+        '''
+        self.operation = operation
+        self.stats = stats
+        self.slowest = slowest
+        self.errors = []
+        self.available = {}
+        self.journal = None
+        self.duration = None
+        self._objects = {}
+        self._order = []
+        self._phases = {}
+        self._current = None
+        self._start = None
+        self._recorder = None
+        self._mutex = threading.Lock()
+
+    def _object(self, path):
+        obj = self._objects.get(path)
+        if obj is None:
+            obj = {'path': path, 'ops': 0, 'phases': {}, 'errors': []}
+            self._objects[path] = obj
+            self._order.append(path)
+        return obj
+
+    def record(self, op, node, seconds):
+        '''
+        Record that operation I{op} on the CFSNode I{node} took I{seconds}.
+        '''
+        if self.stats is not None:
+            self.stats.record(op, node, seconds)
+        phase = PHASES.get(op, op)
+        path = node.path[len(CFSNode.configfs_dir):].strip('/')
+        with self._mutex:
+            obj = self._object(path)
+            obj['ops'] += 1
+            obj['phases'][phase] = obj['phases'].get(phase, 0.0) + seconds
+            self._phases[phase] = self._phases.get(phase, 0.0) + seconds
+
+    def begin(self, path):
+        '''
+        Attribute the errors reported from now on to the object at I{path}.
+        '''
+        self._current = path
+
+    def error(self, err_str):
+        '''
+        Report an error of the current object, see begin().
+        '''
+        with self._mutex:
+            self.errors.append(err_str)
+            if self._current is not None:
+                self._object(self._current)['errors'].append(err_str)
+
+    def start(self):
+        self._start = time.time()
+        self._current = None
+
+    def finish(self, available=None, journal=None):
+        '''
+        @param available: The dict of the seconds at which each Subsystem
+            became available, see Root.restore().
+        @param journal: The RestoreJournal of a restore.
+        '''
+        self.duration = time.time() - self._start
+        self._current = None
+        if available:
+            self.available = dict(available)
+        if journal is not None:
+            self.journal = {'resumed': journal.resumed,
+                            'skipped': journal.skipped}
+
+    def __enter__(self):
+        self._recorder = CFSNode.recorder
+        CFSNode.recorder = self
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        CFSNode.recorder = self._recorder
+        if isinstance(exc_value, CFSError):
+            self.error(str(exc_value))
+        self.finish()
+        return False
+
+    def to_dict(self):
+        '''
+        @return: The report as a dict, with the objects in the order they
+            were first changed or read.
+        '''
+        objects = []
+        for path in self._order:
+            obj = self._objects[path]
+            d = {
+                'path': path,
+                'status': 'failed' if obj['errors'] else 'ok',
+                'ops': obj['ops'],
+                'time': round(sum(obj['phases'].values()), 6),
+                'phases': dict((phase, round(seconds, 6)) for phase, seconds
+                               in iteritems(obj['phases'])),
+            }
+            if obj['errors']:
+                d['errors'] = obj['errors']
+            nqn = path[len('subsystems/'):]
+            if path.startswith('subsystems/') and nqn in self.available:
+                d['available'] = round(self.available[nqn], 6)
+            objects.append(d)
+
+        slowest = sorted(objects, key=lambda d: d['time'], reverse=True)
+        d = {
+            'operation': self.operation,
+            'status': 'failed' if self.errors else 'ok',
+            'duration': round(self.duration or 0.0, 6),
+            'errors': self.errors,
+            'phases': dict((phase, round(seconds, 6)) for phase, seconds
+                           in iteritems(self._phases)),
+            'objects': objects,
+            'slowest': [{'path': o['path'], 'time': o['time']}
+                        for o in slowest[:self.slowest]],
+        }
+        if self.journal is not None:
+            d['journal'] = self.journal
+        return d
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True, indent=2) + "\n"
@@ -1,10 +1,21 @@
 
+import copy
+import fcntl
+import json
 import os
 import random
+import shutil
 import stat
 import string
+import tempfile
 import unittest
 import nvmet.nvme as nvme
+import nvmet.plan as plan
+import nvmet.model as model
+import nvmet.journal as journal
+import nvmet.history as history
+import nvmet.lock as lock
+import nvmet.report as report
 
 # Default test devices are ram disks, but allow user to specify different
 # block devices or files.
@@ -152,6 +163,181 @@ class TestNvmet(unittest.TestCase):
         n.set_enable(1)
         n.delete()
 
+    @unittest.skipUnless(test_devices_present(),
+                         "Devices %s not available or suitable" % ','.join(NVMET_TEST_DEVICES))
+    def test_namespace_reconfigure(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        s = nvme.Subsystem(nqn='testnqn', mode='create')
+        n1 = nvme.Namespace(s, mode='create')
+        n2 = nvme.Namespace(s, mode='create')
+        for n in (n1, n2):
+            n.set_attr('device', 'path', NVMET_TEST_DEVICES[0])
+            n.set_enable(1)
+
+        # invalid values are refused before the namespace is disabled
+        self.assertRaises(nvme.CFSError, n1.reconfigure,
+                          {'device': {'path': '/dev/nonexistent'}})
+        self.assertRaises(nvme.CFSError, n1.reconfigure,
+                          {'device': {'uuid': 'foo'}})
+        self.assertRaises(nvme.CFSError, n1.reconfigure,
+                          {'device': {'size': 1}})
+        self.assertTrue(n1.get_enable())
+
+        nguid = '15f7767b-50e7-4441-949c-75b99153dea7'
+        window = n1.reconfigure({'device': {'path': NVMET_TEST_DEVICES[1],
+                                            'nguid': nguid}})
+        self.assertTrue(window > 0)
+        self.assertTrue(n1.get_enable())
+        self.assertEqual(n1.get_attr('device', 'path'), NVMET_TEST_DEVICES[1])
+        self.assertEqual(n1.get_attr('device', 'nguid'), nguid)
+
+        # nothing changes, no outage
+        self.assertEqual(n1.reconfigure({'device': {'nguid': nguid}}), 0.0)
+
+        results = root.reconfigure_namespaces(
+            [(n, {'device': {'path': NVMET_TEST_DEVICES[1]}})
+             for n in (n1, n2)])
+        self.assertEqual(results[0], 0.0)
+        self.assertTrue(results[1] > 0)
+        self.assertEqual(n2.get_attr('device', 'path'), NVMET_TEST_DEVICES[1])
+        self.assertTrue(n2.get_enable())
+
+    @unittest.skipUnless(test_devices_present(),
+                         "Devices %s not available or suitable" % ','.join(NVMET_TEST_DEVICES))
+    def test_namespace_revalidate(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        s = nvme.Subsystem(nqn='testnqn', mode='create')
+        n1 = nvme.Namespace(s, mode='create')
+        if not os.path.isfile("%s/revalidate_size" % n1.path):
+            self.skipTest("Revalidating the size is not supported")
+        n1.set_attr('device', 'path', NVMET_TEST_DEVICES[0])
+        n2 = nvme.Namespace(s, mode='create')
+        n2.set_attr('device', 'path', NVMET_TEST_DEVICES[1])
+
+        # disabled namespaces can't be revalidated and aren't selected
+        self.assertRaises(nvme.CFSError, n1.revalidate_size)
+        self.assertEqual(root.find_namespaces(), [])
+
+        n1.set_enable(1)
+        n2.set_enable(1)
+        self.assertEqual(root.find_namespaces(nqns=['foo']), [])
+        self.assertEqual(root.find_namespaces(device=NVMET_TEST_DEVICES[1]),
+                         [n2])
+        self.assertEqual(root.find_namespaces(pattern=NVMET_TEST_DEVICES[0]),
+                         [n1])
+
+        size = n1.revalidate_size()
+        self.assertEqual(size, nvme._device_size(NVMET_TEST_DEVICES[0]))
+        self.assertEqual(root.revalidate_namespaces([n2, n1]),
+                         [nvme._device_size(NVMET_TEST_DEVICES[1]), size])
+
+    def test_passthru(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        s = nvme.Subsystem(nqn='testnqn', mode='create')
+        p = s.passthru
+        if p is None:
+            self.skipTest("Passthru not supported")
+        self.assertFalse(p.get_enable())
+        self.assertTrue('device_path' in p.list_attrs('passthru'))
+        self.assertFalse('enable' in p.list_attrs('passthru'))
+
+        # not part of the saved config until a controller is set
+        self.assertFalse('passthru' in s.dump())
+        p.set_attr('passthru', 'device_path', '/dev/nvme0')
+        p.set_attr('passthru', 'io_timeout', 30)
+        d = s.dump()['passthru']
+        self.assertEqual(d['device_path'], '/dev/nvme0')
+        self.assertEqual(d['io_timeout'], '30')
+        self.assertEqual(d['enable'], 0)
+
+        # and listed with the Subsystem
+        info = next(root.list_objects('subsystems/testnqn', depth=1))
+        self.assertEqual(info['passthru'], d)
+        info = next(root.list_objects('subsystems/testnqn', depth=1,
+                                      fields=['passthru.io_timeout']))
+        self.assertEqual(info['passthru'], {'io_timeout': '30'})
+
+        config = root.dump()
+        root.clear_existing()
+        self.assertEqual(root.restore(config), [])
+        p = nvme.Subsystem('testnqn', 'lookup').passthru
+        self.assertEqual(p.get_attr('passthru', 'device_path'), '/dev/nvme0')
+
+    def test_port_profile(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        nvme.Subsystem(nqn='testnqn', mode='create')
+        p1 = nvme.Port(portid=1, mode='create')
+        p1.set_attr('addr', 'trtype', 'loop')
+        p1.add_subsystem('testnqn')
+        p2 = nvme.Port(portid=2, mode='create')
+        p2.set_attr('addr', 'trtype', 'loop')
+        if not root.capabilities.inline_data:
+            self.skipTest("Inline data size not supported")
+
+        profile = {'name': 'loop-inline', 'version': 1, 'trtype': 'loop',
+                   'param': {'inline_data_size': '16384'}}
+        results = root.apply_port_profile(profile)
+        self.assertEqual([p for p, window in results], [p1, p2])
+        self.assertTrue(results[0][1] > 0)
+        self.assertEqual(results[1][1], 0.0)
+        for p in (p1, p2):
+            self.assertEqual(p.get_attr('param', 'inline_data_size'), '16384')
+        self.assertEqual(p1.subsystems, ['testnqn'])
+
+        # ports sharing a subsystem are changed one after the other
+        nvme.Subsystem(nqn='testnqn2', mode='create')
+        p1.add_subsystem('testnqn2')
+        p2.add_subsystem('testnqn')
+        ops = []
+
+        class Recorder(object):
+            def record(self, op, node, seconds):
+                if op in ('symlink', 'unlink'):
+                    ops.append((op, node.portid))
+
+        profile['param']['inline_data_size'] = '8192'
+        outages = {}
+        nvme.CFSNode.recorder = Recorder()
+        try:
+            results = root.apply_port_profile(profile, outages=outages)
+        finally:
+            nvme.CFSNode.recorder = None
+        self.assertTrue(all(window > 0 for p, window in results))
+        self.assertEqual(ops, [('unlink', 1), ('unlink', 1), ('symlink', 1),
+                               ('symlink', 1), ('unlink', 2), ('symlink', 2)])
+        self.assertEqual(outages['testnqn'], 0.0)
+        self.assertEqual(outages['testnqn2'], results[0][1])
+        p1.remove_subsystem('testnqn2')
+        p2.remove_subsystem('testnqn')
+
+        # nothing to change
+        self.assertEqual(p1.apply_profile(profile), 0.0)
+
+        # only the selected ports, and no attributes the kernel lacks
+        self.assertEqual(root.apply_port_profile(profile, portids=[2]),
+                         [(p2, 0.0)])
+        profile['param']['nonexistent'] = '1'
+        self.assertRaises(nvme.CFSError, p1.apply_profile, profile)
+        self.assertEqual(p1.subsystems, ['testnqn'])
+
+        # profiles are kept in the saved configuration
+        tmpdir = tempfile.mkdtemp()
+        savefile = os.path.join(tmpdir, 'config.json')
+        with open(savefile, 'w') as f:
+            f.write(json.dumps({'port_profiles': [profile]}))
+        root.save_to_file(savefile)
+        self.assertEqual(nvme.load_config(savefile)['port_profiles'],
+                         [profile])
+        shutil.rmtree(tmpdir)
+
     def test_recursive_delete(self):
         root = nvme.Root()
         root.clear_existing()
@@ -252,6 +438,50 @@ class TestNvmet(unittest.TestCase):
         p.add_subsystem('testnqn')
         p.delete()
 
+    def test_export_subsystems(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        nvme.Subsystem(nqn='testnqn1', mode='create')
+        nvme.Subsystem(nqn='testnqn2', mode='create')
+        for portid in range(3):
+            p = nvme.Port(portid=portid, mode='create')
+            p.set_attr('addr', 'trtype', 'loop')
+        p.add_subsystem('testnqn1')
+
+        # only the missing links are created
+        linked = root.export_subsystems(['testnqn1', 'testnqn2'],
+                                        trtype='loop', portids=range(1, 3))
+        self.assertEqual(linked, [(1, 'testnqn1'), (1, 'testnqn2'),
+                                  (2, 'testnqn2')])
+        self.assertEqual(nvme.Port(portid=0, mode='lookup').subsystems, [])
+        self.assertEqual(root.export_subsystems(['testnqn1'], trtype='loop',
+                                                portids=range(1, 3)), [])
+
+        # no matching ports
+        self.assertEqual(root.export_subsystems(['testnqn1'], trtype='rdma'),
+                         [])
+
+    def test_capabilities(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        p = nvme.Port(portid=0, mode='create')
+        s = nvme.Subsystem(nqn='testnqn', mode='create')
+
+        # probed once and shared by all objects
+        caps = root.capabilities
+        self.assertIs(p.capabilities, caps)
+        self.assertIs(s.capabilities, caps)
+        for feature in (caps.ana, caps.inline_data, caps.pi, caps.passthru):
+            self.assertIn(feature, (True, False))
+        self.assertEqual(caps.ana,
+                         os.path.isdir("%s/ana_groups" % p.path))
+
+        self.assertIn('trtype', p.list_attrs('addr'))
+        self.assertIn('trtype', p.list_attrs('addr', writable=True))
+        self.assertNotIn('trtype', p.list_attrs('addr', writable=False))
+
     def test_host(self):
         root = nvme.Root()
         root.clear_existing()
@@ -288,6 +518,55 @@ class TestNvmet(unittest.TestCase):
             h.delete()
         self.assertEqual(len(list(root.hosts)), 0)
 
+    def test_host_keys(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        h1 = nvme.Host(nqn='foo', mode='create')
+        h2 = nvme.Host(nqn='bar', mode='create')
+        if 'key' not in h1.list_attrs('dhchap', writable=True):
+            self.skipTest("DH-HMAC-CHAP not supported")
+        self.assertFalse('dhchap' in h1.dump())
+
+        key = 'DHHC-1:00:ia6zGodOr4SEG0Zzaw398rpY0wqipUWj4jWjUh4HWUz6aQ2n:'
+        results = root.rotate_host_keys({
+            'foo': {'key': key},
+            'bar': {'key': 'secret'},
+            'baz': {'key': key},
+        })
+        self.assertEqual(sorted(results), ['bar', 'baz', 'foo'])
+        self.assertIsNone(results['foo'])
+        self.assertTrue(isinstance(results['bar'], nvme.CFSError))
+        self.assertTrue(isinstance(results['baz'], nvme.CFSNotFound))
+        self.assertEqual(h1.get_attr('dhchap', 'key'), key)
+        self.assertEqual(h2.get_attr('dhchap', 'key'), '')
+
+        # keys are saved and restored
+        config = root.dump()
+        hosts = dict((h['nqn'], h) for h in config['hosts'])
+        self.assertEqual(hosts['foo']['dhchap']['key'], key)
+        self.assertFalse('ctrl_key' in hosts['foo']['dhchap'])
+        self.assertFalse('dhchap' in hosts['bar'])
+        root.clear_existing()
+        self.assertEqual(root.restore(config), [])
+        self.assertEqual(nvme.Host('foo', 'lookup').get_attr('dhchap', 'key'),
+                         key)
+
+        # a failed change leaves no new key behind, even on a host
+        # that had none
+        h2 = nvme.Host('bar', 'lookup')
+        set_attr = h2.set_attr
+
+        def failing_set_attr(group, name, value):
+            if name == 'key' and value:
+                raise nvme.CFSError("Cannot set attribute: dhchap_key")
+            set_attr(group, name, value)
+        h2.set_attr = failing_set_attr
+        self.assertRaises(nvme.CFSError, h2.set_keys,
+                          {'key': key, 'ctrl_key': key})
+        self.assertEqual(h2.get_attr('dhchap', 'ctrl_key'), '')
+        self.assertFalse('dhchap' in h2.dump())
+
     def test_referral(self):
         root = nvme.Root()
         root.clear_existing()
@@ -371,6 +650,36 @@ class TestNvmet(unittest.TestCase):
         r1.delete()
         self.assertEqual(len(list(p.referrals)), 0)
 
+    def test_referral_mesh(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        for portid, trsvcid in ((1, '4420'), (2, '4421')):
+            p = nvme.Port(portid=portid, mode='create')
+            p.set_attr('addr', 'trtype', 'tcp')
+            p.set_attr('addr', 'adrfam', 'ipv4')
+            p.set_attr('addr', 'traddr', '192.168.0.1')
+            p.set_attr('addr', 'trsvcid', trsvcid)
+        peers = [{'portid': 5, 'addr': {'trtype': 'tcp', 'adrfam': 'ipv4',
+                                        'traddr': '192.168.0.2',
+                                        'trsvcid': '4420'}}]
+
+        self.assertEqual(root.apply_referral_mesh(peers), [])
+        p = nvme.Port(portid=1, mode='lookup')
+        refs = dict((r.get_attr('addr', 'traddr') + ':' +
+                     r.get_attr('addr', 'trsvcid'), r) for r in p.referrals)
+        self.assertEqual(sorted(refs),
+                         ['192.168.0.1:4421', '192.168.0.2:4420'])
+        self.assertEqual(refs['192.168.0.2:4420'].get_attr('addr', 'portid'),
+                         '5')
+        self.assertTrue(refs['192.168.0.2:4420'].get_enable())
+        self.assertEqual(len(list(nvme.Port(2, 'lookup').referrals)), 2)
+
+        # nothing left to do, and a removed peer is pruned
+        self.assertEqual(len(root.plan_referral_mesh(peers)), 0)
+        root.apply_referral_mesh([])
+        self.assertEqual(len(list(p.referrals)), 1)
+
     def test_allowed_hosts(self):
         root = nvme.Root()
 
@@ -396,6 +705,307 @@ class TestNvmet(unittest.TestCase):
         # invalid removal
         self.assertRaises(nvme.CFSError, s.remove_allowed_host, 'foobar')
 
+    def test_sync_allowed_hosts(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        nvme.Host(nqn='hostnqn1', mode='create')
+        s1 = nvme.Subsystem(nqn='testnqn1', mode='create')
+        s2 = nvme.Subsystem(nqn='testnqn2', mode='create')
+        s1.add_allowed_host(nqn='hostnqn1')
+
+        # missing hosts are created, existing links are kept
+        added, removed = root.sync_allowed_hosts(
+            {'testnqn1': ['hostnqn1', 'hostnqn2'], 'testnqn2': ['hostnqn2']})
+        self.assertEqual((added, removed), (2, 0))
+        self.assertEqual(len(list(root.hosts)), 2)
+        self.assertEqual(sorted(s1.allowed_hosts), ['hostnqn1', 'hostnqn2'])
+        self.assertEqual(s2.allowed_hosts, ['hostnqn2'])
+
+        # same ACL again is a no-op
+        self.assertEqual(root.sync_allowed_hosts(
+            {'testnqn1': ['hostnqn1', 'hostnqn2'],
+             'testnqn2': ['hostnqn2']}), (0, 0))
+
+        # by host, only the listed host is touched
+        added, removed = root.sync_allowed_hosts({'hostnqn2': ['testnqn1']},
+                                                 by_host=True)
+        self.assertEqual((added, removed), (0, 1))
+        self.assertEqual(sorted(s1.allowed_hosts), ['hostnqn1', 'hostnqn2'])
+        self.assertEqual(s2.allowed_hosts, [])
+
+        # undefined hosts
+        self.assertRaises(nvme.CFSError, root.sync_allowed_hosts,
+                          {'testnqn2': ['invalid']}, create_hosts=False)
+
+        # an unknown subsystem leaves every ACL untouched
+        self.assertRaises(nvme.CFSNotFound, root.sync_allowed_hosts,
+                          {'testnqn1': [], 'testnqn2': ['hostnqn3'],
+                           'invalid': ['hostnqn1']})
+        self.assertRaises(nvme.CFSNotFound, root.sync_allowed_hosts,
+                          {'hostnqn1': ['testnqn2', 'invalid']}, by_host=True)
+        self.assertEqual(sorted(s1.allowed_hosts), ['hostnqn1', 'hostnqn2'])
+        self.assertEqual(s2.allowed_hosts, [])
+        self.assertEqual(len(list(root.hosts)), 2)
+
+    def test_access_index(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        nvme.Host(nqn='hostnqn', mode='create')
+        s1 = nvme.Subsystem(nqn='testnqn1', mode='create')
+        s1.add_allowed_host(nqn='hostnqn')
+        nvme.Subsystem(nqn='testnqn2', mode='create')
+        s3 = nvme.Subsystem(nqn='testnqn3', mode='create')
+        s3.set_attr('attr', 'allow_any_host', 1)
+
+        p = nvme.Port(portid=1, mode='create')
+        p.set_attr('addr', 'trtype', 'loop')
+        p.add_subsystem('testnqn1')
+
+        index = root.access_index()
+        self.assertEqual(index.ports_exporting('testnqn1'), [1])
+        self.assertEqual(index.ports_exporting('testnqn2'), [])
+        self.assertEqual(index.subsystems_for_host('hostnqn'),
+                         ['testnqn1', 'testnqn3'])
+        self.assertEqual(index.host_access('hostnqn'),
+                         [('testnqn1', [1]), ('testnqn3', [])])
+        self.assertEqual(index.subsystems_for_host('otherhost'),
+                         ['testnqn3'])
+
+    def test_list_objects(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        nvme.Host(nqn='hostnqn', mode='create')
+        for nqn in ('testnqn2', 'testnqn1'):
+            s = nvme.Subsystem(nqn=nqn, mode='create')
+            nvme.Namespace(s, nsid=10, mode='create')
+            nvme.Namespace(s, nsid=2, mode='create')
+        s.add_allowed_host('hostnqn')
+        p = nvme.Port(portid=1, mode='create')
+        p.set_attr('addr', 'trtype', 'loop')
+
+        paths = [o['path'] for o in root.list_objects(depth=1)]
+        self.assertEqual(paths, ['subsystems/testnqn1', 'subsystems/testnqn2',
+                                 'ports/1', 'hosts/hostnqn'])
+
+        objs = list(root.list_objects('subsystems/testnqn1'))
+        self.assertEqual([o['path'] for o in objs],
+                         ['subsystems/testnqn1',
+                          'subsystems/testnqn1/namespaces/2',
+                          'subsystems/testnqn1/namespaces/10'])
+        self.assertEqual(objs[0]['type'], 'subsystem')
+        self.assertEqual(objs[0]['allowed_hosts'], ['hostnqn'])
+        self.assertEqual(objs[1]['nsid'], 2)
+
+        objs = list(root.list_objects('ports', depth=1,
+                                      fields=['addr.trtype']))
+        self.assertEqual(objs, [{'path': 'ports/1', 'type': 'port',
+                                 'portid': 1, 'addr': {'trtype': 'loop'}}])
+
+        paths = [o['path'] for o in root.list_objects('subsystems', offset=2,
+                                                      limit=2)]
+        self.assertEqual(paths, ['subsystems/testnqn1/namespaces/10',
+                                 'subsystems/testnqn2'])
+
+        self.assertRaises(nvme.CFSNotFound, list,
+                          root.list_objects('subsystems/missingnqn'))
+        self.assertRaises(nvme.CFSNotFound, list,
+                          root.list_objects('nosuchdir'))
+
+    def test_restore_journal(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        config = {
+            'subsystems': [{
+                'nqn': 'testnqn%d' % i,
+                'attr': {'allow_any_host': '0'},
+                'namespaces': [{'nsid': 1}, {'nsid': 2}],
+            } for i in (1, 2)],
+            'ports': [{
+                'portid': 1,
+                'addr': {'trtype': 'loop'},
+                'subsystems': ['testnqn1', 'testnqn2'],
+            }],
+        }
+
+        # Leave a restore interrupted after the first subsystem
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'restore.journal')
+        j = journal.RestoreJournal(path)
+        j.open(config)
+        s = nvme.Subsystem(nqn='testnqn1', mode='create')
+        s.set_attr('attr', 'allow_any_host', 1)
+        nvme.Namespace(s, nsid=1, mode='create')
+        j.checkpoint('subsystems/testnqn1')
+        s = nvme.Subsystem(nqn='testnqn2', mode='create')
+        nvme.Namespace(s, nsid=1, mode='create')
+        j.checkpoint('subsystems/testnqn2/namespaces/1')
+        p = nvme.Port(portid=1, mode='create')
+        p.set_attr('addr', 'trtype', 'loop')
+        p.add_subsystem('testnqn1')
+        j.close()
+
+        j = journal.RestoreJournal(path)
+        self.assertEqual(root.restore(config, clear_existing=True,
+                                      journal=j), [])
+        self.assertTrue(j.resumed)
+        self.assertEqual(j.skipped, 2)
+        self.assertFalse(os.path.exists(path))
+
+        # The completed subsystem was left alone
+        s = nvme.Subsystem(nqn='testnqn1', mode='lookup')
+        self.assertEqual(s.get_attr('attr', 'allow_any_host'), '1')
+        self.assertEqual([ns.nsid for ns in s.namespaces], [1])
+        s = nvme.Subsystem(nqn='testnqn2', mode='lookup')
+        self.assertEqual(sorted(ns.nsid for ns in s.namespaces), [1, 2])
+        p = nvme.Port(portid=1, mode='lookup')
+        self.assertEqual(sorted(p.subsystems), ['testnqn1', 'testnqn2'])
+        shutil.rmtree(tmpdir)
+
+    def test_restore_priority(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        config = {
+            'subsystems': [
+                {'nqn': 'testnqn1', 'namespaces': [{'nsid': 1}]},
+                {'nqn': 'testnqn2', 'priority': 1, 'namespaces': []},
+                {'nqn': 'testnqn3',
+                 'namespaces': [{'nsid': 1}, {'nsid': 2, 'priority': 2}]},
+            ],
+            'ports': [{
+                'portid': 1,
+                'addr': {'trtype': 'loop'},
+                'subsystems': ['testnqn1', 'testnqn2', 'testnqn3'],
+            }],
+        }
+        available = {}
+        self.assertEqual(root.restore(config, available=available), [])
+        self.assertEqual(sorted(available, key=available.get),
+                         ['testnqn3', 'testnqn2', 'testnqn1'])
+        p = nvme.Port(portid=1, mode='lookup')
+        self.assertEqual(sorted(p.subsystems),
+                         ['testnqn1', 'testnqn2', 'testnqn3'])
+
+        # Priorities are kept when saving over the config
+        tmpdir = tempfile.mkdtemp()
+        savefile = os.path.join(tmpdir, 'config.json')
+        with open(savefile, 'w') as f:
+            f.write(json.dumps(config))
+        root.save_to_file(savefile)
+        saved = dict((t['nqn'], t) for t in
+                     nvme.load_config(savefile)['subsystems'])
+        self.assertEqual(saved['testnqn2']['priority'], 1)
+        self.assertNotIn('priority', saved['testnqn1'])
+        self.assertEqual([n.get('priority') for n in
+                          sorted(saved['testnqn3']['namespaces'],
+                                 key=lambda n: n['nsid'])], [None, 2])
+        shutil.rmtree(tmpdir)
+
+    def test_restore_report(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        config = {
+            'subsystems': [{'nqn': 'testnqn', 'namespaces': [{'nsid': 1}],
+                            'attr': {'nosuchattr': '1'}}],
+            'ports': [{'portid': 1, 'addr': {'trtype': 'loop'},
+                       'subsystems': ['testnqn']}],
+        }
+        r = report.Report('restore')
+        errors = root.restore(config, validate=False, report=r)
+        self.assertEqual(len(errors), 1)
+        d = r.to_dict()
+        self.assertEqual(d['status'], 'failed')
+        objects = dict((o['path'], o) for o in d['objects'])
+        self.assertEqual(objects['subsystems/testnqn']['status'], 'failed')
+        self.assertIn('available', objects['subsystems/testnqn'])
+        self.assertEqual(objects['subsystems/testnqn/namespaces/1']['status'],
+                         'ok')
+        self.assertIn('mkdir', objects['ports/1']['phases'])
+        self.assertIn('attrs', objects['ports/1']['phases'])
+        self.assertIn('link', objects['ports/1']['phases'])
+        self.assertIn('subsystems/testnqn', [o['path'] for o in d['slowest']])
+        self.assertIsNone(nvme.CFSNode.recorder)
+
+        with report.Report('clear') as r:
+            root.clear_existing()
+        self.assertEqual(r.to_dict()['status'], 'ok')
+        self.assertIn('rmdir', r.to_dict()['phases'])
+
+        # an invalid config is reported too
+        r = report.Report('restore')
+        self.assertRaises(nvme.CFSError, root.restore,
+                          {'ports': [{'portid': 'invalid'}]}, report=r)
+        self.assertEqual(r.to_dict()['status'], 'failed')
+        self.assertEqual(len(r.errors), 1)
+
+    def test_restore_pipelined(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        ops = []
+
+        class Recorder(object):
+            def record(self, op, node, seconds):
+                ops.append((op, node.path[len(nvme.Root.configfs_dir) + 1:]))
+
+        config = {
+            'subsystems': [{'nqn': 'testnqn%d' % i, 'namespaces': []}
+                           for i in (1, 2)],
+            'ports': [{
+                'portid': 1,
+                'addr': {'trtype': 'loop'},
+                'subsystems': ['testnqn1', 'testnqn2'],
+            }],
+        }
+        self.assertEqual(root.restore(config, stats=Recorder()), [])
+
+        # The port exists first, and each subsystem is linked right away
+        ops = [op for op in ops if op[0] in ('mkdir', 'symlink')]
+        self.assertEqual(ops, [('mkdir', 'ports/1'),
+                               ('mkdir', 'subsystems/testnqn1'),
+                               ('symlink', 'ports/1'),
+                               ('mkdir', 'subsystems/testnqn2'),
+                               ('symlink', 'ports/1')])
+
+    def test_rollback(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        nvme.Host(nqn='hostnqn', mode='create')
+        s = nvme.Subsystem(nqn='testnqn', mode='create')
+        s.add_allowed_host('hostnqn')
+        s2 = nvme.Subsystem(nqn='testnqn2', mode='create')
+        p = nvme.Port(portid=1, mode='create')
+        p.set_attr('addr', 'trtype', 'loop')
+        p.add_subsystem('testnqn')
+
+        tmpdir = tempfile.mkdtemp()
+        h = history.History(os.path.join(tmpdir, 'history'))
+        root.save_to_file(os.path.join(tmpdir, 'config.json'), history=h)
+        snapshot_id = h.snapshots()[-1][1]
+
+        s.remove_allowed_host('hostnqn')
+        s2.set_attr('attr', 'allow_any_host', 1)
+        p.remove_subsystem('testnqn')
+        nvme.Subsystem(nqn='testnqn3', mode='create')
+
+        plan = root.plan_restore(h.load(snapshot_id), diff=True)
+        self.assertEqual(plan.counts()['rmdir'], 1)
+        self.assertEqual(root.apply_changes(h.load(snapshot_id[:8])), [])
+        self.assertEqual(s.allowed_hosts, ['hostnqn'])
+        self.assertEqual(s2.get_attr('attr', 'allow_any_host'), '0')
+        self.assertEqual(p.subsystems, ['testnqn'])
+        self.assertEqual(sorted(x.nqn for x in root.subsystems),
+                         ['testnqn', 'testnqn2'])
+        self.assertEqual(len(root.plan_restore(h.load(snapshot_id),
+                                               diff=True)), 0)
+        shutil.rmtree(tmpdir)
+
     def test_invalid_input(self):
         root = nvme.Root()
         root.clear_existing()
@@ -482,3 +1092,591 @@ class TestNvmet(unittest.TestCase):
         self.assertEqual(p.get_attr('addr', 'trsvcid'), '1023')
         self.assertIn('testnqn', p.subsystems)
         self.assertNotIn('testtnqn2', p.subsystems)
+
+    def test_save_restore_dir(self):
+        root = nvme.Root()
+        root.clear_existing()
+
+        nvme.Host(nqn='hostnqn', mode='create')
+        s = nvme.Subsystem(nqn='testnqn', mode='create')
+        s.add_allowed_host(nqn='hostnqn')
+        nvme.Subsystem(nqn='testnqn2', mode='create')
+        p = nvme.Port(portid=66, mode='create')
+        p.set_attr('addr', 'trtype', 'loop')
+        p.add_subsystem('testnqn')
+
+        savedir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(root.save_to_dir(savedir),
+                             ['hosts.json', 'port-66.json',
+                              'subsystem-testnqn.json',
+                              'subsystem-testnqn2.json'])
+
+            # nothing changed, nothing written
+            self.assertEqual(root.save_to_dir(savedir), [])
+            self.assertEqual(root.dump(max_workers=4), root.dump())
+            self.assertEqual(root.save_to_dir(savedir, max_workers=4), [])
+
+            # only the shard of the removed subsystem changes
+            nvme.Subsystem(nqn='testnqn2', mode='lookup').delete()
+            self.assertEqual(root.save_to_dir(savedir),
+                             ['subsystem-testnqn2.json'])
+
+            root.clear_existing()
+            root.restore_from_file(savedir)
+
+            s = nvme.Subsystem(nqn='testnqn', mode='lookup')
+            p = nvme.Port(portid=66, mode='lookup')
+            self.assertIn('hostnqn', s.allowed_hosts)
+            self.assertIn('testnqn', p.subsystems)
+            self.assertEqual(len(list(root.subsystems)), 1)
+        finally:
+            shutil.rmtree(savedir)
+
+    def test_save_restore_default(self):
+        root = nvme.Root()
+        root.clear_existing()
+        nvme.Subsystem(nqn='testnqn', mode='create')
+
+        savedir = tempfile.mkdtemp()
+        defaults = nvme.DEFAULT_SAVE_FILE, nvme.DEFAULT_SAVE_DIR
+        nvme.DEFAULT_SAVE_FILE = os.path.join(savedir, 'config.json')
+        nvme.DEFAULT_SAVE_DIR = os.path.join(savedir, 'config.d')
+        try:
+            # the directory is stale once the file is saved
+            root.save_to_dir()
+            nvme.Subsystem(nqn='testnqn', mode='lookup').delete()
+            nvme.Subsystem(nqn='testnqn2', mode='create')
+            root.save_to_file()
+            self.assertEqual(nvme.load_config(), root.dump())
+
+            # and the file once the directory is saved
+            nvme.Subsystem(nqn='testnqn3', mode='create')
+            root.save_to_dir()
+            self.assertFalse(os.path.exists(nvme.DEFAULT_SAVE_FILE))
+            root.clear_existing()
+            root.restore(nvme.load_config())
+            self.assertEqual(sorted(s.nqn for s in root.subsystems),
+                             ['testnqn2', 'testnqn3'])
+        finally:
+            nvme.DEFAULT_SAVE_FILE, nvme.DEFAULT_SAVE_DIR = defaults
+            shutil.rmtree(savedir)
+
+    def test_aio(self):
+        import asyncio
+        import nvmet.aio as aio
+
+        root = nvme.Root()
+        root.clear_existing()
+
+        nvme.Host(nqn='hostnqn', mode='create')
+        for i in range(4):
+            s = nvme.Subsystem(nqn='testnqn%d' % i, mode='create')
+            s.add_allowed_host(nqn='hostnqn')
+        p = nvme.Port(portid=1, mode='create')
+        p.set_attr('addr', 'trtype', 'loop')
+        p.add_subsystem('testnqn1')
+        config = root.dump()
+
+        async def run():
+            aroot = await aio.AsyncRoot.open(max_workers=2)
+            try:
+                self.assertEqual(await aroot.dump(), config)
+                self.assertEqual(
+                    await aroot.restore(config, clear_existing=True), [])
+                self.assertEqual(await aroot.dump(), config)
+
+                s = await aroot.subsystem('testnqn0', mode='lookup')
+                ns = await s.namespace(mode='create')
+                self.assertEqual(ns.nsid, 1)
+                self.assertEqual(await s.allowed_hosts(), ['hostnqn'])
+            finally:
+                aroot.close()
+
+        asyncio.run(run())
+
+
+class TestRestorePlan(unittest.TestCase):
+    config = {
+        'hosts': [{'nqn': 'hostnqn'}],
+        'subsystems': [{
+            'nqn': 'testnqn',
+            'attr': {'allow_any_host': '0'},
+            'allowed_hosts': ['hostnqn'],
+            'namespaces': [{
+                'nsid': 1,
+                'device': {'path': '/dev/ram0'},
+                'enable': 1,
+            }],
+        }],
+        'ports': [{
+            'portid': 1,
+            'addr': {'trtype': 'loop'},
+            'subsystems': ['testnqn'],
+            'ana_groups': [],
+            'referrals': [],
+        }],
+    }
+
+    def test_full(self):
+        p = plan.RestorePlan(self.config)
+        self.assertEqual(p.ops, [
+            ('mkdir', 'hosts/hostnqn', None),
+            ('mkdir', 'ports/1', None),
+            ('write', 'ports/1/addr_trtype', 'loop'),
+            ('mkdir', 'subsystems/testnqn', None),
+            ('mkdir', 'subsystems/testnqn/namespaces/1', None),
+            ('write', 'subsystems/testnqn/namespaces/1/device_path',
+             '/dev/ram0'),
+            ('enable', 'subsystems/testnqn/namespaces/1/enable', 1),
+            ('symlink', 'subsystems/testnqn/allowed_hosts/hostnqn',
+             'hosts/hostnqn'),
+            ('write', 'subsystems/testnqn/attr_allow_any_host', '0'),
+            ('symlink', 'ports/1/subsystems/testnqn', 'subsystems/testnqn'),
+        ])
+        self.assertEqual(p.counts()['mkdir'], 4)
+
+        # Subsystems in order of priority, each exported once it is set up
+        config = {
+            'subsystems': [{'nqn': 'low'}, {'nqn': 'high', 'priority': 1}],
+            'ports': [{'portid': 1, 'subsystems': ['low', 'high']}],
+        }
+        self.assertEqual(plan.RestorePlan(config).ops, [
+            ('mkdir', 'ports/1', None),
+            ('mkdir', 'subsystems/high', None),
+            ('symlink', 'ports/1/subsystems/high', 'subsystems/high'),
+            ('mkdir', 'subsystems/low', None),
+            ('symlink', 'ports/1/subsystems/low', 'subsystems/low'),
+        ])
+
+        stats = plan.OpStats()
+        for i in range(4):
+            stats.record('enable', None, 0.5)
+        self.assertAlmostEqual(p.estimate(stats) - p.estimate(), 0.5 - 0.02)
+
+        # disabling is timed apart from enabling
+        stats.record('disable', None, 0.1)
+        self.assertAlmostEqual(stats.latency('enable'), 0.5)
+        self.assertEqual(plan.stats_op('enable', 0), 'disable')
+        self.assertEqual(plan.stats_op('enable', 1), 'enable')
+        config = copy.deepcopy(self.config)
+        config['subsystems'][0]['namespaces'][0]['enable'] = 0
+        p = plan.RestorePlan(config, self.config)
+        self.assertEqual(p.ops, [
+            ('enable', 'subsystems/testnqn/namespaces/1/enable', 0)])
+        self.assertAlmostEqual(p.estimate(stats), 0.1)
+
+    def test_diff(self):
+        self.assertEqual(len(plan.RestorePlan(self.config, self.config)), 0)
+
+        live = self.config
+        config = copy.deepcopy(live)
+        config['subsystems'][0]['namespaces'][0]['device']['path'] = \
+            '/dev/ram1'
+        config['ports'][0]['subsystems'] = []
+        self.assertEqual(plan.RestorePlan(config, live).ops, [
+            ('unlink', 'ports/1/subsystems/testnqn', 'subsystems/testnqn'),
+            ('enable', 'subsystems/testnqn/namespaces/1/enable', 0),
+            ('write', 'subsystems/testnqn/namespaces/1/device_path',
+             '/dev/ram1'),
+            ('enable', 'subsystems/testnqn/namespaces/1/enable', 1),
+        ])
+
+        # a linked port is unlinked around any attribute change
+        tuned = copy.deepcopy(live)
+        tuned['ports'][0]['param'] = {'inline_data_size': '16384'}
+        self.assertEqual(plan.RestorePlan(tuned, live).ops, [
+            ('unlink', 'ports/1/subsystems/testnqn', 'subsystems/testnqn'),
+            ('write', 'ports/1/param_inline_data_size', '16384'),
+            ('symlink', 'ports/1/subsystems/testnqn', 'subsystems/testnqn'),
+        ])
+
+        # clearing tears down everything before rebuilding
+        p = plan.RestorePlan(config, live, clear_existing=True)
+        self.assertEqual(p.ops[:5], [
+            ('unlink', 'ports/1/subsystems/testnqn', 'subsystems/testnqn'),
+            ('rmdir', 'ports/1', None),
+            ('rmdir', 'subsystems/testnqn/namespaces/1', None),
+            ('unlink', 'subsystems/testnqn/allowed_hosts/hostnqn',
+             'hosts/hostnqn'),
+            ('rmdir', 'subsystems/testnqn', None),
+        ])
+
+    def test_passthru(self):
+        config = {'subsystems': [{
+            'nqn': 'testnqn',
+            'namespaces': [],
+            'passthru': {'device_path': '/dev/nvme0', 'io_timeout': '30',
+                         'enable': 1},
+        }]}
+        self.assertEqual(plan.RestorePlan(config).ops, [
+            ('mkdir', 'subsystems/testnqn', None),
+            ('write', 'subsystems/testnqn/passthru/device_path',
+             '/dev/nvme0'),
+            ('write', 'subsystems/testnqn/passthru/io_timeout', '30'),
+            ('enable', 'subsystems/testnqn/passthru/enable', 1),
+        ])
+
+        live = config
+        config = copy.deepcopy(live)
+        config['subsystems'][0]['passthru']['device_path'] = '/dev/nvme1'
+        self.assertEqual(plan.RestorePlan(config, live).ops, [
+            ('enable', 'subsystems/testnqn/passthru/enable', 0),
+            ('write', 'subsystems/testnqn/passthru/device_path',
+             '/dev/nvme1'),
+            ('enable', 'subsystems/testnqn/passthru/enable', 1),
+        ])
+        self.assertEqual(plan.RestorePlan({}, live).ops, [
+            ('enable', 'subsystems/testnqn/passthru/enable', 0),
+            ('rmdir', 'subsystems/testnqn', None),
+        ])
+
+    def test_referral_mesh(self):
+        def port(portid, traddr, trtype='tcp', referrals=None):
+            return {'portid': portid,
+                    'addr': {'trtype': trtype, 'adrfam': 'ipv4',
+                             'traddr': traddr, 'trsvcid': '4420'},
+                    'subsystems': [], 'ana_groups': [],
+                    'referrals': referrals or []}
+
+        stale = {'name': 'stale', 'enable': 1,
+                 'addr': {'trtype': 'tcp', 'adrfam': 'ipv4',
+                          'traddr': '10.0.0.9', 'trsvcid': '4420'}}
+        ports = [port(1, '10.0.0.1', referrals=[stale]),
+                 port(2, '10.0.0.1', 'rdma'),
+                 port(3, '', 'loop')]
+        # the list of all cluster ports, including our own
+        peers = [port(1, '10.0.0.1'), port(7, '10.0.0.2'),
+                 port(8, '10.0.0.2', 'rdma')]
+        meshed = plan.referral_mesh(ports, peers)
+        self.assertEqual(meshed[0]['referrals'], [
+            {'name': 'tcp-ipv4-10.0.0.2-4420', 'enable': 1,
+             'addr': {'trtype': 'tcp', 'adrfam': 'ipv4',
+                      'traddr': '10.0.0.2', 'trsvcid': '4420',
+                      'portid': '7'}},
+        ])
+        self.assertEqual([r['addr']['portid'] for r in
+                          meshed[1]['referrals']], ['8'])
+        self.assertEqual(meshed[2]['referrals'], [])
+        self.assertEqual(ports[0]['referrals'], [stale])
+
+        live = {'ports': ports}
+        self.assertEqual(plan.RestorePlan({'ports': meshed}, live).ops[:3], [
+            ('rmdir', 'ports/1/referrals/stale', None),
+            ('mkdir', 'ports/1/referrals/tcp-ipv4-10.0.0.2-4420', None),
+            ('write', 'ports/1/referrals/tcp-ipv4-10.0.0.2-4420/addr_adrfam',
+             'ipv4'),
+        ])
+        self.assertEqual(
+            len(plan.RestorePlan({'ports': meshed}, {'ports': meshed})), 0)
+
+        # only rdma ports, keeping other referrals
+        meshed = plan.referral_mesh(ports, peers, 'rdma', prune=False)
+        self.assertEqual(meshed[0], ports[0])
+        self.assertEqual(len(meshed[1]['referrals']), 1)
+
+
+class TestConfigModel(unittest.TestCase):
+    def test_edit(self):
+        c = model.Config()
+        c.add_host('hostnqn')
+        s = c.add_subsystem('testnqn')
+        s.set_attr('attr', 'allow_any_host', 0)
+        self.assertEqual(s.add_namespace(path='/dev/ram0', enable=1).nsid, 1)
+        self.assertEqual(s.add_namespace(3).nsid, 3)
+        self.assertEqual(s.add_namespace().nsid, 2)
+        c.allow_host('testnqn', 'hostnqn')
+        c.add_port(1, trtype='loop')
+        c.export('testnqn', 1)
+
+        # invalid edits
+        self.assertRaises(nvme.CFSError, c.add_subsystem, 'testnqn')
+        self.assertRaises(nvme.CFSError, s.add_namespace, 3)
+        self.assertRaises(nvme.CFSError, s.add_namespace, 0)
+        self.assertRaises(nvme.CFSError, c.allow_host, 'testnqn', 'invalid')
+        self.assertRaises(nvme.CFSError, c.allow_host, 'invalid', 'hostnqn')
+        self.assertRaises(nvme.CFSError, c.export, 'invalid', 1)
+        self.assertRaises(nvme.CFSError, c.export, 'testnqn', 2)
+        self.assertRaises(nvme.CFSError, c.remove_port, 2)
+        self.assertRaises(nvme.CFSError, c.add_port, 1 << 17)
+
+        self.assertEqual(c.ports_exporting('testnqn'), [1])
+        self.assertEqual(c.subsystems_for_host('hostnqn'), ['testnqn'])
+
+        # removing a subsystem drops its port links
+        c.remove_subsystem('testnqn')
+        self.assertEqual(c.ports[1].subsystems, [])
+        self.assertEqual(c.subsystems_for_host('hostnqn'), [])
+
+    def test_port_profile(self):
+        c = model.Config()
+        t = c.set_port_profile('fast', 'tcp',
+                               param={'inline_data_size': 16384})
+        self.assertEqual(t, {'name': 'fast', 'trtype': 'tcp', 'version': 1,
+                             'param': {'inline_data_size': '16384'}})
+        c.set_port_profile('fast', 'tcp', param={'inline_data_size': 16384})
+        self.assertEqual(c.port_profiles['fast']['version'], 1)
+        c.set_port_profile('fast', 'tcp', param={'inline_data_size': 8192})
+        self.assertEqual(c.port_profiles['fast']['version'], 2)
+
+        config = c.to_dict()
+        self.assertEqual(nvme.validate_config(config), [])
+        self.assertEqual(model.Config.from_dict(config).to_dict(), config)
+        c.remove_port_profile('fast')
+        self.assertFalse('port_profiles' in c.to_dict())
+
+    def test_round_trip(self):
+        config = copy.deepcopy(TestRestorePlan.config)
+        config['subsystems'][0]['priority'] = 5
+        c = model.Config.from_dict(config)
+        self.assertEqual(c.to_dict(), config)
+
+        savefile = tempfile.mktemp()
+        try:
+            c.save(savefile)
+            self.assertEqual(os.stat(savefile).st_mode & 0o777, 0o600)
+            self.assertEqual(model.Config.load(savefile).to_dict(), config)
+        finally:
+            os.unlink(savefile)
+
+
+class TestValidateConfig(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(nvme.validate_config(TestRestorePlan.config), [])
+        self.assertEqual(nvme.validate_config({}), [])
+
+    def test_invalid(self):
+        config = copy.deepcopy(TestRestorePlan.config)
+        s = config['subsystems'][0]
+        s['allowed_hosts'].append('invalid')
+        s['namespaces'].append({'nsid': 1, 'ana_grpid': 2})
+        s['namespaces'].append({'nsid': 0})
+        config['ports'][0]['subsystems'].append('invalid')
+        for portid in (2, 3):
+            config['ports'].append({
+                'portid': portid,
+                'addr': {'trtype': 'tcp', 'adrfam': 'ipv4',
+                         'traddr': '192.168.0.1', 'trsvcid': '4420'}})
+
+        self.assertEqual(nvme.validate_config(config), [
+            "Subsystem invalid of port 1 not defined",
+            "Port 3 uses the same address as port 2",
+            "Allowed host invalid of subsystem testnqn not defined",
+            "NSID 1 of subsystem testnqn defined twice",
+            "ANA Group 2 of namespace 1 of subsystem testnqn not defined",
+            "NSID 0 must be 1 to 8192",
+        ])
+        self.assertEqual(model.Config.from_dict(TestRestorePlan.config)
+                         .validate(), [])
+
+    def test_priority(self):
+        config = copy.deepcopy(TestRestorePlan.config)
+        s = config['subsystems'][0]
+        s['priority'] = 10
+        s['namespaces'][0]['priority'] = -1
+        self.assertEqual(nvme.validate_config(config), [])
+        self.assertEqual(model.Config.from_dict(config)
+                         .subsystems['testnqn'].priority, 10)
+        self.assertEqual(model.Config.from_dict(config).to_dict()
+                         ['subsystems'][0]['namespaces'][0]['priority'], -1)
+
+        s['priority'] = '10'
+        self.assertEqual(nvme.validate_config(config), [
+            "Priority '10' of subsystem testnqn is not an integer",
+        ])
+
+    def test_passthru(self):
+        config = copy.deepcopy(TestRestorePlan.config)
+        s = config['subsystems'][0]
+        s['passthru'] = {'device_path': '/dev/nvme0', 'enable': 0}
+        self.assertEqual(nvme.validate_config(config), [])
+        self.assertEqual(model.Config.from_dict(config).to_dict(), config)
+
+        s['passthru'] = {'enable': 1}
+        self.assertEqual(nvme.validate_config(config), [
+            "Passthru of subsystem testnqn enabled without a device_path",
+            "Passthru of subsystem testnqn enabled but it has namespaces",
+        ])
+
+
+    def test_port_profiles(self):
+        config = copy.deepcopy(TestRestorePlan.config)
+        config['port_profiles'] = [
+            {'name': 'fast', 'trtype': 'tcp', 'version': 1,
+             'param': {'inline_data_size': '16384'}},
+            {'name': 'fast', 'trtype': 'tcp', 'addr': {'trsvcid': '4420'}},
+            {'name': 'slow', 'version': '2'},
+        ]
+        self.assertEqual(nvme.validate_config(config), [
+            "Port profile fast defined twice",
+            "Addresses can't be set by port profile fast",
+            "'trtype' not defined in port profile slow",
+            "Version '2' of port profile slow is not an integer",
+        ])
+
+
+class TestRestoreJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'restore.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume(self):
+        config = TestRestorePlan.config
+        j = journal.RestoreJournal(self.path)
+        j.open(config)
+        self.assertFalse(j.resumed)
+        j.checkpoint('subsystems/testnqn')
+        j.close()
+
+        j = journal.RestoreJournal(self.path)
+        j.open(config)
+        self.assertTrue(j.resumed)
+        self.assertTrue(j.done('subsystems/testnqn'))
+        self.assertFalse(j.done('ports/1'))
+        j.finish()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_other_config(self):
+        j = journal.RestoreJournal(self.path)
+        j.open(TestRestorePlan.config)
+        j.checkpoint('subsystems/testnqn')
+        j.close()
+
+        config = copy.deepcopy(TestRestorePlan.config)
+        config['subsystems'][0]['attr']['allow_any_host'] = '1'
+        j = journal.RestoreJournal(self.path)
+        j.open(config)
+        self.assertFalse(j.resumed)
+        self.assertFalse(j.done('subsystems/testnqn'))
+        j.close()
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.history = history.History(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def count_objects(self):
+        return sum(len(files) for _, _, files in
+                   os.walk(os.path.join(self.tmpdir, 'objects')))
+
+    def test_snapshot(self):
+        config = copy.deepcopy(TestRestorePlan.config)
+        first = self.history.snapshot(config)
+        self.assertEqual(self.history.snapshot(config), first)
+        self.assertEqual(len(self.history.snapshots()), 1)
+        self.assertEqual(self.count_objects(), 3)
+
+        # Only the changed subsystem is stored again
+        config['subsystems'][0]['attr']['allow_any_host'] = '1'
+        second = self.history.snapshot(config)
+        self.assertNotEqual(second, first)
+        self.assertEqual([i for t, i in self.history.snapshots()],
+                         [first, second])
+        self.assertEqual(self.count_objects(), 4)
+
+        self.assertEqual(self.history.load(first), TestRestorePlan.config)
+        self.assertEqual(self.history.load(second[:10]), config)
+        self.assertRaises(nvme.CFSError, self.history.load, 'nosuchid')
+        self.assertRaises(nvme.CFSError, self.history.load, '')
+
+
+class TestLock(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.locks = lock.LockManager(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def try_lock(self, name, exclusive):
+        # A separate open file, as another process would use
+        fd = os.open(os.path.join(self.tmpdir, name + '.lock'),
+                     os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) |
+                        fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError):
+            return False
+        finally:
+            os.close(fd)
+
+    def test_object_lock(self):
+        with self.locks.locked('subsystem', 'testnqn'):
+            self.assertFalse(self.locks.holds_global())
+            self.assertFalse(self.try_lock('subsystem-testnqn', False))
+            self.assertTrue(self.try_lock('subsystem-othernqn', True))
+            self.assertTrue(self.try_lock('global', False))
+            self.assertFalse(self.try_lock('global', True))
+            # Nested locks of the same process are granted at once
+            with self.locks.locked('subsystem', 'testnqn'):
+                pass
+            self.assertFalse(self.try_lock('subsystem-testnqn', False))
+            self.assertRaises(nvme.CFSError,
+                              self.locks.locked().__enter__)
+        self.assertTrue(self.try_lock('subsystem-testnqn', True))
+        self.assertTrue(self.try_lock('global', True))
+
+    def test_global_lock(self):
+        with self.locks.locked():
+            self.assertTrue(self.locks.holds_global())
+            self.assertFalse(self.try_lock('global', False))
+            # Object locks are implied by the global lock
+            with self.locks.locked('port', '1'):
+                self.assertTrue(self.try_lock('port-1', True))
+        self.assertFalse(self.locks.holds_global())
+        self.assertTrue(self.try_lock('global', True))
+
+
+class TestReport(unittest.TestCase):
+    class Node(object):
+        def __init__(self, path):
+            self.path = nvme.CFSNode.configfs_dir + '/' + path
+
+    def test_report(self):
+        stats = plan.OpStats()
+        r = report.Report('restore', stats, slowest=1)
+        ns = self.Node('subsystems/testnqn/namespaces/1')
+        with r:
+            self.assertIs(nvme.CFSNode.recorder, r)
+            r.record('mkdir', self.Node('subsystems/testnqn'), 0.5)
+            r.record('write', ns, 0.25)
+            r.record('read', ns, 0.25)
+            r.record('enable', ns, 2.0)
+            r.begin('subsystems/testnqn')
+            r.error('Could not do it')
+        self.assertIsNone(nvme.CFSNode.recorder)
+        self.assertEqual(stats.count, {'mkdir': 1, 'write': 1, 'enable': 1})
+
+        d = r.to_dict()
+        self.assertEqual(d['status'], 'failed')
+        self.assertEqual(d['phases'], {'mkdir': 0.5, 'attrs': 0.25,
+                                       'read': 0.25, 'enable': 2.0})
+        self.assertEqual(d['objects'], [
+            {'path': 'subsystems/testnqn', 'status': 'failed', 'ops': 1,
+             'time': 0.5, 'phases': {'mkdir': 0.5},
+             'errors': ['Could not do it']},
+            {'path': 'subsystems/testnqn/namespaces/1', 'status': 'ok',
+             'ops': 3, 'time': 2.5,
+             'phases': {'attrs': 0.25, 'read': 0.25, 'enable': 2.0}},
+        ])
+        self.assertEqual(d['slowest'], [
+            {'path': 'subsystems/testnqn/namespaces/1', 'time': 2.5}])
+        self.assertEqual(json.loads(r.to_json()), d)
+
+    def test_failure(self):
+        r = report.Report('clear')
+        try:
+            with r:
+                raise nvme.CFSError('Could not clear')
+        except nvme.CFSError:
+            pass
+        self.assertEqual(r.to_dict()['errors'], ['Could not clear'])
+        self.assertIsNotNone(r.duration)